@@ -0,0 +1,496 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import redirect_stdout
+from urllib.parse import urlsplit, parse_qs
+from email.parser import BytesParser
+import multiprocessing
+import threading
+import itertools
+import argparse
+import tempfile
+import shutil
+import resource
+import hashlib
+import logging
+import base64
+import random
+import asyncio
+import struct
+import zlib
+import json
+import math
+import time
+import sys
+import io
+import os
+
+
+# Offline benchmark of the async pipeline.
+#
+# Local stand-ins replace every external service: a SERP endpoint that replays
+# `test.json`-shaped responses, an image host with configurable latency and
+# size distributions, the Gemini generateContent API and the Drive API with its
+# OAuth token endpoint. They all run in a separate process so they do not
+# compete with the pipeline for the event loop. The run context is built the
+# way a real run builds it (open_run_context, the Gemini SDK, DriveUploader and
+# the Drive index), pointed at the stand-ins through the endpoint settings.
+# Synthetic rows are pushed through the real Pipeline and the run reports
+# rows/s, images/s, p50/p99 per stage and peak RSS.
+#
+#     python benchmark.py --rows 50 --images-per-query 100 --json bench.json
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+
+
+def lognormal(rng, median, sigma):
+    """
+    Draw from a log-normal distribution given its median; a median of 0 gives 0.
+    """
+    if median <= 0:
+        return 0.0
+    return rng.lognormvariate(math.log(median), sigma)
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+# local services
+
+def _png(width, height, seed):
+    """
+    A small valid PNG with a seeded gradient, built without any imaging library.
+    """
+    rows = bytearray()
+    for y in range(height):
+        rows.append(0)
+        for x in range(width):
+            rows += bytes(((x * 7 + seed) % 256, (y * 5 + seed) % 256, (x * y + seed) % 256))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(bytes(rows))) + chunk(b'IEND', b'')
+
+
+class FakeServices:
+    """
+    Settings and handlers of the fake SERP endpoint and image host.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        with open(args.serp_template, 'r', encoding='utf-8') as f:
+            template = json.load(f)
+        self.image_entry = dict(template['images'][0]) if template.get('images') else {}
+        self.template = {key: value for key, value in template.items() if key != 'images'}
+        self.base_images = [_png(64 + 32 * i, 48 + 24 * i, i) for i in range(8)]
+        self.image_host = None
+        self.drive_lock = threading.Lock()
+        self.drive_folders = {}
+        self.drive_ids = itertools.count(1)
+
+    def serp_body(self, query, start=0):
+        rng = random.Random(hashlib.sha1(f'{query}:{start}'.encode('utf-8')).digest())
+        query_key = hashlib.sha1(query.encode('utf-8')).hexdigest()[:12]
+        images = []
+        for position in range(self.args.images_per_query):
+            if rng.random() < self.args.duplicate_ratio:
+                # shared across queries, so the duplicate checks get exercised
+                key = f'shared-{rng.randrange(self.args.shared_pool)}'
+            else:
+                key = f'{query_key}-{start + position}'
+            entry = dict(self.image_entry)
+            entry.update(
+                image=f'{self.image_host}/img/{key}.png',
+                link=f'https://example.org/{key}',
+                title=f'{query} {position}',
+                source='example.org'
+            )
+            images.append(entry)
+        body = dict(self.template)
+        body['images'] = images
+        return json.dumps(body, ensure_ascii=False).encode('utf-8')
+
+    def image_body(self, key):
+        rng = random.Random(key)
+        base = self.base_images[rng.randrange(len(self.base_images))]
+        size = int(min(self.args.image_size_max, lognormal(rng, self.args.image_size_median, self.args.image_size_sigma)))
+        # decoders ignore what follows the end of the image; the key keeps every body unique
+        padding = max(0, size - len(base) - len(key))
+        return base + key.encode('utf-8') + bytes(padding)
+
+    def gemini_body(self, request):
+        """
+        Answer a generateContent request with scores derived from the image bytes,
+        so reruns give the same verdicts.
+        """
+        parts = [part for content in request.get('contents', []) for part in content.get('parts', [])]
+        verdicts = []
+        for part in parts:
+            inline = part.get('inlineData') or part.get('inline_data')
+            if inline:
+                digest = hashlib.sha256(base64.b64decode(inline['data'])).digest()
+                score = 9 if digest[0] < 256 * self.args.accept_ratio else 3
+                verdicts.append({'score_1_to_10': score, 'Final_Verdict': 'Y' if score > 7 else 'N'})
+        if any(part.get('text', '').startswith('Image ') for part in parts):
+            text = json.dumps([dict(verdict, image=number) for number, verdict in enumerate(verdicts, start=1)])
+        else:
+            text = json.dumps(verdicts[0] if verdicts else {})
+        response = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP', 'index': 0}]}
+        return json.dumps(response).encode('utf-8')
+
+    def drive_folder(self, name):
+        with self.drive_lock:
+            if name not in self.drive_folders:
+                self.drive_folders[name] = f'folder-{next(self.drive_ids)}'
+            return self.drive_folders[name]
+
+    def drive_file(self, data):
+        with self.drive_lock:
+            file_id = f'file-{next(self.drive_ids)}'
+        return {'id': file_id, 'md5Checksum': hashlib.md5(data).hexdigest(), 'size': str(len(data))}
+
+    def drive_list(self, query):
+        """
+        Folders are the only files the pipeline looks up by name.
+        """
+        if "name='" not in query:
+            return {'files': []}
+        name = query.split("name='", 1)[1].split("'", 1)[0]
+        with self.drive_lock:
+            folder_id = self.drive_folders.get(name)
+        return {'files': [{'id': folder_id, 'name': name}] if folder_id else []}
+
+
+def _media(content_type, body):
+    """
+    The file bytes of a multipart/related Drive upload.
+    """
+    message = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + body)
+    parts = message.get_payload() if message.is_multipart() else []
+    return parts[-1].get_payload(decode=True) if parts else body
+
+
+def _handler(services):
+    args = services.args
+    rng = random.Random()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == '/search':
+                time.sleep(lognormal(rng, args.serp_latency, args.latency_sigma))
+                if rng.random() < args.serp_error_rate:
+                    self.send_error(503)
+                    return
+                params = parse_qs(url.query)
+                body = services.serp_body(params.get('q', [''])[0], int(params.get('start', ['0'])[0]))
+                self._send(body, 'application/json')
+            elif url.path.startswith('/img/'):
+                time.sleep(lognormal(rng, args.image_latency, args.latency_sigma))
+                if rng.random() < args.image_error_rate:
+                    self.send_error(404)
+                    return
+                self._send(services.image_body(url.path[len('/img/'):]), 'image/png')
+            elif url.path == '/drive/v3/changes/startPageToken':
+                self._send_json({'startPageToken': '1'})
+            elif url.path == '/drive/v3/changes':
+                self._send_json({'newStartPageToken': '1', 'changes': []})
+            elif url.path == '/drive/v3/files':
+                self._send_json(services.drive_list(parse_qs(url.query).get('q', [''])[0]))
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if url.path == '/token':
+                self._send_json({'access_token': 'benchmark', 'expires_in': 3600, 'token_type': 'Bearer'})
+            elif url.path.endswith(':generateContent'):
+                time.sleep(lognormal(rng, args.gemini_latency, args.latency_sigma))
+                self._send(services.gemini_body(json.loads(body)), 'application/json')
+            elif url.path == '/drive/v3/files':
+                self._send_json({'id': services.drive_folder(json.loads(body)['name'])})
+            elif url.path == '/upload/drive/v3/files':
+                if 'uploadType=resumable' in url.query:
+                    # the file bytes follow in a PUT to the session URL
+                    self.send_response(200)
+                    self.send_header('Location', f'{services.image_host}/upload/drive/v3/files?upload_id={next(services.drive_ids)}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                time.sleep(lognormal(rng, args.drive_latency, args.latency_sigma))
+                self._send_json(services.drive_file(_media(self.headers.get('Content-Type', ''), body)))
+            else:
+                self.send_error(404)
+
+        def do_PUT(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if urlsplit(self.path).path != '/upload/drive/v3/files':
+                self.send_error(404)
+                return
+            time.sleep(lognormal(rng, args.drive_latency, args.latency_sigma))
+            self._send_json(services.drive_file(body))
+
+        def _send_json(self, data):
+            self._send(json.dumps(data).encode('utf-8'), 'application/json')
+
+        def _send(self, body, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(args, ready):
+    """
+    Run the stand-in services until the parent process exits.
+    """
+    services = FakeServices(args)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _handler(services))
+    server.daemon_threads = True
+    services.image_host = f'http://127.0.0.1:{server.server_address[1]}'
+    ready.send(services.image_host)
+    server.serve_forever()
+
+
+def write_service_account(path, token_uri):
+    """
+    Write service account credentials with a throwaway key whose tokens come from `token_uri`.
+    """
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives import serialization
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode('ascii')
+    with open(path, 'w') as f:
+        json.dump({
+            'type': 'service_account',
+            'project_id': 'benchmark',
+            'private_key_id': 'benchmark',
+            'private_key': private_key,
+            'client_email': 'benchmark@benchmark.iam.gserviceaccount.com',
+            'client_id': '0',
+            'token_uri': token_uri
+        }, f)
+
+
+# benchmark
+
+def stage_timings(pipeline_class):
+    """
+    A Pipeline subclass that records how long every stage spends on each item.
+    """
+    timings = {}
+
+    class TimedPipeline(pipeline_class):
+
+        async def _worker(self, name, queue, handler):
+            samples = timings.setdefault(name, [])
+
+            async def timed(item):
+                started = time.monotonic()
+                try:
+                    await handler(item)
+                finally:
+                    samples.append(time.monotonic() - started)
+
+            await super()._worker(name, queue, timed)
+
+    return TimedPipeline, timings
+
+
+async def run_pipeline(pipeline_async, args):
+    """
+    Run synthetic rows through the pipeline, with the run context a real run
+    would open, and return (timings, seconds, rows).
+    """
+    rows = [
+        pipeline_async.RowTask(
+            'Benchmark', row_index,
+            [f'benchmark row {row_index} query {number}' for number in range(args.queries_per_row)],
+            'Is this the pest?', f'label-{row_index % args.labels}', label=f'label-{row_index % args.labels}'
+        )
+        for row_index in range(args.rows)
+    ]
+
+    pipeline_class, timings = stage_timings(pipeline_async.Pipeline)
+    async with pipeline_async.open_run_context() as ctx:
+        pipeline = pipeline_class(ctx)
+        started = time.monotonic()
+        await pipeline.run(rows)
+        seconds = time.monotonic() - started
+    # wait for the image processes to exit, so their peak RSS is counted
+    pipeline.image_executor.shutdown(wait=True)
+    return timings, seconds, len(rows)
+
+
+def reap_forkserver():
+    """
+    Stop the forkserver the image processes were started from. Only children
+    that have been waited for count in RUSAGE_CHILDREN, and the image processes
+    are the forkserver's children. multiprocessing has no public way to do this,
+    so returns False when its private API is not there.
+    """
+    from multiprocessing import forkserver
+
+    stop = getattr(getattr(forkserver, '_forkserver', None), '_stop', None)
+    if stop is None:
+        return False
+    stop()
+    return True
+
+
+def build_report(timings, seconds, rows, image_processes_counted=True):
+    from metrics import IMAGES_DOWNLOADED, VERDICTS, UPLOADS, SERP_QUERIES, SERP_PAGES, URLS_SKIPPED, PREFILTER_REJECTIONS
+
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    report = {
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows / seconds, 3),
+        'images_downloaded': IMAGES_DOWNLOADED.value(result='new'),
+        'images_per_second': round(IMAGES_DOWNLOADED.value(result='new') / seconds, 3),
+        'serp_queries': SERP_QUERIES.total(),
+        'serp_pages': SERP_PAGES.value(result='fetched'),
+        'urls_skipped': URLS_SKIPPED.value(),
+        'accepted': VERDICTS.value(verdict='accepted'),
+        'rejected': VERDICTS.value(verdict='rejected'),
+        'prefiltered': VERDICTS.value(verdict='prefiltered'),
+        'prefilter_reasons': {key[0]: value for _, key, _, value in PREFILTER_REJECTIONS.samples()},
+        'uploads': UPLOADS.value(result='uploaded'),
+        # ru_maxrss is in KiB on Linux; the children are the stand-in services and the image processes
+        'peak_rss_mb': round(own / 1024, 1),
+        'peak_child_rss_mb': round(children / 1024, 1),
+        'child_rss_includes_image_processes': image_processes_counted,
+        'stages': {}
+    }
+    for stage, samples in timings.items():
+        if samples:
+            report['stages'][stage] = {
+                'items': len(samples),
+                'p50_ms': round(percentile(samples, 0.50) * 1000, 2),
+                'p99_ms': round(percentile(samples, 0.99) * 1000, 2),
+            }
+    return report
+
+
+def format_report(report):
+    lines = [
+        f"{report['rows']} rows in {report['seconds']:.2f}s: {report['rows_per_second']:.2f} rows/s, "
+        f"{report['images_per_second']:.1f} images/s ({report['images_downloaded']} images)",
+        f"verdicts: {report['accepted']} accepted, {report['rejected']} rejected, {report['prefiltered']} prefiltered {report['prefilter_reasons']}; "
+        f"{report['uploads']} uploads",
+        f"peak RSS: {report['peak_rss_mb']} MiB (largest child {report['peak_child_rss_mb']} MiB"
+        f"{'' if report['child_rss_includes_image_processes'] else ', image processes not counted'})",
+        f"{'stage':<10} {'items':>8} {'p50 ms':>10} {'p99 ms':>10}",
+    ]
+    for stage, stats in report['stages'].items():
+        lines.append(f"{stage:<10} {stats['items']:>8} {stats['p50_ms']:>10.2f} {stats['p99_ms']:>10.2f}")
+    return '\n'.join(lines)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline offline against local stand-in services.')
+    parser.add_argument('--rows', type=int, default=20)
+    parser.add_argument('--queries-per-row', type=int, default=3)
+    parser.add_argument('--images-per-query', type=int, default=100)
+    parser.add_argument('--labels', type=int, default=5, help='number of distinct label folders')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1, help='share of image URLs drawn from a shared pool')
+    parser.add_argument('--shared-pool', type=int, default=200)
+    parser.add_argument('--serp-template', default=os.path.join(current_directory, 'test.json'))
+    parser.add_argument('--serp-latency', type=float, default=0.5, help='median SERP latency in seconds')
+    parser.add_argument('--serp-error-rate', type=float, default=0.0)
+    parser.add_argument('--image-latency', type=float, default=0.05, help='median image latency in seconds')
+    parser.add_argument('--image-error-rate', type=float, default=0.02)
+    parser.add_argument('--image-size-median', type=int, default=150 * 1024, help='median image size in bytes')
+    parser.add_argument('--image-size-sigma', type=float, default=0.8)
+    parser.add_argument('--image-size-max', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--gemini-latency', type=float, default=1.5, help='median Gemini latency in seconds')
+    parser.add_argument('--accept-ratio', type=float, default=0.4)
+    parser.add_argument('--drive-latency', type=float, default=0.3, help='median Drive upload latency in seconds')
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--keep-rate-limits', action='store_true', help='keep the production rate limits')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the store, journal and logs of the run')
+    parser.add_argument('--log', action='store_true', help='show the pipeline log')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    json_path = os.path.abspath(args.json) if args.json else None
+    start_directory = os.getcwd()
+
+    context = multiprocessing.get_context('spawn')
+    parent_end, child_end = context.Pipe()
+    server = context.Process(target=serve, args=(args, child_end), daemon=True)
+    server.start()
+    host = parent_end.recv()
+
+    work_dir = tempfile.mkdtemp(prefix='images-benchmark-')
+    # main_async reads its credentials from the working directory
+    write_service_account(os.path.join(work_dir, 'service_account.json'), f'{host}/token')
+    os.environ.update({
+        'serp_search_url': f'{host}/search',
+        'gemini_api_endpoint': host,
+        'drive_root_url': f'{host}/',
+        'google_api_key': 'benchmark',
+        'google_drive_parent_folder_id': 'benchmark-parent',
+        # SERP requests go straight to the stand-in rather than through the proxy
+        'host': ''
+    })
+    if not args.keep_rate_limits:
+        # the stand-ins have no quotas; concurrency limits still apply
+        for backend in ('serp', 'gemini', 'drive'):
+            os.environ.setdefault(f'{backend}_rate', '100000')
+            os.environ.setdefault(f'{backend}_burst', '100000')
+
+    # main_async keeps its images and logs under the working directory
+    os.chdir(work_dir)
+    sys.path.insert(0, current_directory)
+    import main_async
+
+    if not args.log:
+        # injected failures would flood the output
+        logging.disable(logging.ERROR)
+    image_processes_counted = False
+    try:
+        with redirect_stdout(io.StringIO()):
+            timings, seconds, rows = asyncio.run(run_pipeline(main_async, args))
+    finally:
+        main_async.close_clients()
+        server.terminate()
+        server.join()
+        image_processes_counted = reap_forkserver()
+        os.chdir(start_directory)
+
+    report = build_report(timings, seconds, rows, image_processes_counted)
+    print(format_report(report))
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=4)
+    if args.keep:
+        print(f"Benchmark files kept in {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import sys
+
+
+SHEETS = ('Plagas', 'Deficiencias')
+
+# subcommand -> pipeline stages it runs
+COMMAND_STAGES = {
+    'search': ('search',),
+    'download': ('download',),
+    'score': ('score',),
+    'upload': ('upload',),
+    'run': ('search', 'download', 'score', 'upload'),
+    'export': (),
+}
+
+COMMAND_HELP = {
+    'search': 'fetch SERP results into the cache',
+    'download': 'download the images of cached SERP results into the image store',
+    'score': 'score downloaded images with Gemini',
+    'upload': 'upload accepted images to Google Drive',
+    'run': 'run every stage',
+    'export': 'append accepted images with their labels to the training dataset shards',
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='cli.py',
+        description='Collect training images for the spreadsheet rows. Each stage can be run on its own; '
+                    'progress is kept in the run journal, so later stages pick up where earlier ones stopped.'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+    for command, help_text in COMMAND_HELP.items():
+        subparser = commands.add_parser(command, help=help_text)
+        subparser.add_argument(
+            '--sheet', action='append', choices=SHEETS, dest='sheets',
+            help='only process this sheet (can be repeated, default: all sheets)'
+        )
+        if command == 'run':
+            subparser.add_argument(
+                '--workers', type=int, default=None,
+                help='number of worker processes sharing the work queue (default: worker_processes)'
+            )
+            subparser.add_argument(
+                '--join', action='store_true', default=None,
+                help='add workers to a queue planned on another machine'
+            )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    stages = COMMAND_STAGES[args.command]
+    sheets = tuple(args.sheets or SHEETS)
+
+    # imported after parsing so that --help and argument errors stay instant
+    import main_async
+
+    if args.command == 'export':
+        main_async.export_dataset(sheets)
+        return 0
+
+    if args.command == 'run':
+        workers = main_async.worker_processes if args.workers is None else args.workers
+        join = main_async.join_queue if args.join is None else args.join
+        if workers > 1 or join:
+            main_async.run_queue(workers, plan=not join, sheets=sheets)
+            return 0
+
+    try:
+        asyncio.run(main_async.main(stages=stages, sheets=sheets))
+    finally:
+        main_async.close_clients()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
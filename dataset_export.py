@@ -0,0 +1,194 @@
+import tarfile
+import logging
+import mmap
+import json
+import glob
+import time
+import io
+import os
+
+
+SHARD_PATTERN = 'shard-{:06d}.tar'
+INDEX_SUFFIX = '.index.jsonl'
+
+
+def _clean(value):
+    # missing spreadsheet cells come through as NaN
+    return None if value is None or value != value else value
+
+
+class ShardWriter:
+    """
+    Writes accepted images and their labels into tar shards for training.
+
+    Each sample is stored as two tar members, `<key>.<ext>` with the image bytes
+    and `<key>.json` with its labels, so the shards can also be read as plain tar
+    or WebDataset files. Next to every shard an index file holds one JSON line
+    per sample with the byte offset and size of the image inside the tar, so a
+    reader can memory-map the shard and slice any sample without scanning it.
+
+    A shard is written under a temporary name and renamed, together with its
+    index, only once it is complete, so readers never see partial shards. A new
+    shard is started when the current one reaches `max_bytes` or `max_samples`.
+    Reopening the directory continues with the next shard number and skips
+    samples whose keys are already exported, so the dataset grows incrementally
+    as more rows are processed.
+    """
+
+    def __init__(self, dataset_dir, max_bytes=1024 ** 3, max_samples=10000):
+        self.dataset_dir = dataset_dir
+        self.max_bytes = max_bytes
+        self.max_samples = max_samples
+        self.exported = set()
+        self.shards_written = 0
+        self._next_shard = 0
+        self._tar = None
+        self._tar_path = None
+        self._index = []
+        os.makedirs(dataset_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """
+        Collect the keys of the complete shards and drop leftovers of an interrupted export.
+        """
+        for tmp_path in glob.glob(os.path.join(self.dataset_dir, '*.tmp')):
+            os.remove(tmp_path)
+
+        for index_path in sorted(glob.glob(os.path.join(self.dataset_dir, '*' + INDEX_SUFFIX))):
+            shard_name = os.path.basename(index_path)[:-len(INDEX_SUFFIX)]
+            self._next_shard = max(self._next_shard, int(shard_name.split('-')[1].split('.')[0]) + 1)
+            with open(index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self.exported.add(json.loads(line)['key'])
+        logging.info(f"Dataset at {self.dataset_dir} has {len(self.exported)} samples in {self._next_shard} shards")
+
+    def __contains__(self, key):
+        return key in self.exported
+
+    def _open_shard(self):
+        self._tar_path = os.path.join(self.dataset_dir, SHARD_PATTERN.format(self._next_shard))
+        self._next_shard += 1
+        self._tar = tarfile.open(f'{self._tar_path}.tmp', 'w', format=tarfile.USTAR_FORMAT)
+        self._index = []
+
+    def _add_member(self, name, data):
+        """
+        Append one member and return the offset of its data within the tar.
+        """
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self._tar.addfile(info, io.BytesIO(data))
+        # members are padded to whole 512-byte blocks
+        return self._tar.offset - (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+    def add(self, key, image_data, ext, labels):
+        """
+        Add one sample. Returns False if the key was already exported.
+        """
+        if key in self.exported:
+            return False
+        if self._tar is None:
+            self._open_shard()
+
+        labels = {name: _clean(value) for name, value in labels.items()}
+        offset = self._add_member(f'{key}.{ext}', image_data)
+        self._add_member(f'{key}.json', json.dumps(dict(labels, key=key), ensure_ascii=False).encode('utf-8'))
+        self._index.append({'key': key, 'offset': offset, 'size': len(image_data), 'ext': ext, 'labels': labels})
+        self.exported.add(key)
+
+        if len(self._index) >= self.max_samples or self._tar.offset >= self.max_bytes:
+            self.close_shard()
+        return True
+
+    def close_shard(self):
+        """
+        Finish the current shard and publish it with its index.
+        """
+        if self._tar is None:
+            return
+        self._tar.close()
+        self._tar = None
+
+        index_path = self._tar_path[:-len('.tar')] + INDEX_SUFFIX
+        with open(f'{index_path}.tmp', 'w', encoding='utf-8') as f:
+            for entry in self._index:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(f'{self._tar_path}.tmp', self._tar_path)
+        # the index appears last: a shard without one is never read
+        os.replace(f'{index_path}.tmp', index_path)
+        self.shards_written += 1
+        logging.info(f"Wrote dataset shard {self._tar_path} with {len(self._index)} samples")
+
+    def close(self):
+        self.close_shard()
+
+
+class ShardReader:
+    """
+    Random access to the samples of one shard through a memory map of the tar.
+    """
+
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+        with open(shard_path[:-len('.tar')] + INDEX_SUFFIX, 'r', encoding='utf-8') as f:
+            self.index = [json.loads(line) for line in f]
+        self._positions = {entry['key']: position for position, entry in enumerate(self.index)}
+        self._file = open(shard_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.index else None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, position):
+        """
+        Return (image bytes, labels) for the sample at `position`.
+        """
+        entry = self.index[position]
+        return self._map[entry['offset']:entry['offset'] + entry['size']], entry['labels']
+
+    def get(self, key):
+        return self[self._positions[key]]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def sample_key(sheet, row_index, digest):
+    return f'{sheet}-{int(row_index):05d}-{digest[:32]}'
+
+
+def export_accepted(journal, store, row_labels, writer):
+    """
+    Export every accepted image in the journal that is not in the dataset yet.
+    `row_labels` maps (sheet, row_index) to the labels of that spreadsheet row;
+    images of rows it does not know are skipped. Returns the number of samples added.
+    """
+    added = 0
+    for sheet, row, _, record in journal.images():
+        accepted = record['stage'] == 'uploaded' or (record['stage'] == 'scored' and record.get('relevant'))
+        labels = row_labels.get((sheet, int(row)))
+        if not accepted or labels is None:
+            continue
+        key = sample_key(sheet, row, record['digest'])
+        if key in writer:
+            continue
+        image_data = store.read(record['digest'])
+        if image_data is None:
+            logging.warning(f"Accepted image missing from the store, not exported: {record['digest']}")
+            continue
+        ext = os.path.splitext(store.path_for(record['digest']))[1][1:]
+        writer.add(key, image_data, ext, dict(labels, sheet=sheet, row=int(row), digest=record['digest']))
+        added += 1
+    writer.close_shard()
+    return added
@@ -1,16 +1,25 @@
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient import discovery_cache
 from googleapiclient.http import MediaFileUpload
+from rate_limiter import get_limiter
+from metrics import UPLOADS, UPLOAD_LATENCY
+import mimetypes
 import logging
+import json
 import os
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# files up to this size are sent in a single multipart request
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
 
-def authenticate_drive(cred_file):
+
+def authenticate_drive(cred_file, root_url=None):
     """
     Authenticate Google Drive API using a service account.
+    `root_url` points the client at another API root, e.g. a local stand-in.
     """
 
     try:
@@ -18,7 +27,14 @@ def authenticate_drive(cred_file):
             cred_file,
             scopes=["https://www.googleapis.com/auth/drive"]
         )
-        drive_service = build('drive', 'v3', credentials=credentials)
+        if root_url:
+            # upload URLs are built from the discovery document's rootUrl, which
+            # client_options cannot change
+            document = json.loads(discovery_cache.get_static_doc('drive', 'v3'))
+            document['rootUrl'] = root_url
+            drive_service = build_from_document(document, credentials=credentials)
+        else:
+            drive_service = build('drive', 'v3', credentials=credentials)
         logging.info("Google Drive authentication successful.")
         print("Google Drive authentication successful.")
         return drive_service
@@ -72,23 +88,37 @@ def get_or_create_gd_folder(service, folder_name, parent_id=None):
         return None
 
 
+def build_upload_request(service, file_path, folder_id, resumable_threshold=RESUMABLE_UPLOAD_THRESHOLD, fields='id'):
+    """
+    Build the files().create request for an upload.
+    Small files use a simple multipart upload; only large files use a resumable session.
+    """
+    file_metadata = {
+        'name': os.path.basename(file_path),
+        'parents': [folder_id]
+    }
+    mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    resumable = os.path.getsize(file_path) > resumable_threshold
+    media = MediaFileUpload(file_path, mimetype=mimetype, resumable=resumable)
+    return service.files().create(body=file_metadata, media_body=media, fields=fields)
+
+
 def upload_file(service, file_path, folder_id):
     """
     Upload a file to Google Drive, within a specific folder.
+    Rate-limit and server errors are retried under the shared Drive rate limiter.
     """
     try:
-        file_metadata = {
-            'name': os.path.basename(file_path),
-            'parents': [folder_id]
-        }
-        media = MediaFileUpload(file_path, resumable=True)
-        file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+        with UPLOAD_LATENCY.time():
+            file = get_limiter('drive').call(build_upload_request(service, file_path, folder_id).execute)
         logging.info(f"File uploaded successfully: {file_path}")
         print(f"File uploaded successfully: {file_path}")
+        UPLOADS.inc(result='uploaded')
         return file.get('id')
     except Exception as e:
         logging.error(f"Failed to upload file {file_path}: {e}")
         print(f"Failed to upload file {file_path}: {e}")
+        UPLOADS.inc(result='failed')
         return None
 
 
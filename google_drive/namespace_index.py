@@ -0,0 +1,216 @@
+import threading
+import logging
+import json
+import os
+
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+FILE_FIELDS = 'id, name, mimeType, md5Checksum, size, parents, trashed'
+
+
+class DriveNamespaceIndex:
+    """
+    Local index of the folders under a Drive parent folder and the files inside them.
+
+    The index is built with one paginated listing of the parent's folders and one
+    of their files, and is then kept current through the Drive changes API, so
+    folder resolution and duplicate-upload checks are local lookups. When
+    `snapshot_path` is given the index and its changes page token are saved
+    there, and the next run only replays the changes since then.
+    """
+
+    def __init__(self, service, parent_id, snapshot_path=None):
+        self.service = service
+        self.parent_id = parent_id
+        self.snapshot_path = snapshot_path
+        self.folders = {}
+        self.files = {}
+        self.page_token = None
+        self._paths = {}
+        self._lock = threading.RLock()
+
+    def load(self):
+        """
+        Load the index from the snapshot and refresh it, or list the parent folder from scratch.
+        """
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            if snapshot.get('parent_id') == self.parent_id:
+                self.folders = snapshot['folders']
+                self.files = {folder_id: {name: tuple(entry) for name, entry in entries.items()}
+                              for folder_id, entries in snapshot['files'].items()}
+                self.page_token = snapshot['page_token']
+                self._index_paths()
+                self.refresh()
+                return self
+        self.rebuild()
+        return self
+
+    def _list(self, query):
+        """
+        Yield every file matching a query, following pagination.
+        """
+        page_token = None
+        while True:
+            response = self.service.files().list(
+                q=query,
+                spaces='drive',
+                fields=f'nextPageToken, files({FILE_FIELDS})',
+                pageSize=1000,
+                pageToken=page_token
+            ).execute()
+            yield from response.get('files', [])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+    def rebuild(self):
+        """
+        List the folders under the parent and their files, replacing the current index.
+        """
+        with self._lock:
+            # Take the changes token first so nothing made during the listing is missed.
+            self.page_token = self.service.changes().getStartPageToken().execute()['startPageToken']
+            self.folders = {}
+            self.files = {}
+            self._paths = {}
+
+            for folder in self._list(f"'{self.parent_id}' in parents and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"):
+                self._add_folder(folder['id'], folder['name'])
+
+            folder_ids = list(self.files)
+            for start in range(0, len(folder_ids), 50):
+                parents = ' or '.join(f"'{folder_id}' in parents" for folder_id in folder_ids[start:start + 50])
+                for file in self._list(f"({parents}) and mimeType!='{FOLDER_MIME_TYPE}' and trashed=false"):
+                    self._add(file)
+
+        logging.info(f"Drive index built with {len(self.folders)} folders and {self.file_count()} files")
+
+    def refresh(self):
+        """
+        Apply the changes made on Drive since the last listing or refresh.
+        """
+        with self._lock:
+            page_token = self.page_token
+            while page_token:
+                response = self.service.changes().list(
+                    pageToken=page_token,
+                    spaces='drive',
+                    fields=f'nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}))',
+                    pageSize=1000
+                ).execute()
+                for change in response.get('changes', []):
+                    self._apply_change(change)
+                if 'newStartPageToken' in response:
+                    self.page_token = response['newStartPageToken']
+                page_token = response.get('nextPageToken')
+
+    def _apply_change(self, change):
+        file_id = change['fileId']
+        file = change.get('file')
+        self._remove(file_id)
+        if change.get('removed') or not file or file.get('trashed'):
+            return
+        if file.get('mimeType') == FOLDER_MIME_TYPE:
+            if self.parent_id in file.get('parents', []):
+                self._add_folder(file_id, file['name'])
+        else:
+            self._add(file)
+
+    def _index_paths(self):
+        """
+        Rebuild the file ID -> location map used to apply changes.
+        """
+        self._paths = {folder_id: (None, name) for name, folder_id in self.folders.items()}
+        for folder_id, entries in self.files.items():
+            for name, entry in entries.items():
+                self._paths.setdefault(entry[0], (folder_id, name))
+
+    def _add_folder(self, folder_id, name):
+        self.folders[name] = folder_id
+        self.files.setdefault(folder_id, {})
+        self._paths[folder_id] = (None, name)
+
+    def _add(self, file):
+        for parent in file.get('parents', []):
+            if parent in self.files:
+                self.files[parent][file['name']] = (file['id'], file.get('md5Checksum'), int(file.get('size', 0)))
+                self._paths[file['id']] = (parent, file['name'])
+
+    def _remove(self, file_id):
+        location = self._paths.pop(file_id, None)
+        if location is None:
+            return
+        folder_id, name = location
+        if folder_id is None:
+            if self.folders.get(name) == file_id:
+                del self.folders[name]
+        else:
+            entries = self.files.get(folder_id, {})
+            if name in entries and entries[name][0] == file_id:
+                del entries[name]
+
+    def file_count(self):
+        return sum(len(entries) for entries in self.files.values())
+
+    def get_or_create_folder(self, folder_name):
+        """
+        Return the ID of the folder under the parent, creating it on Drive if it is not indexed.
+        """
+        with self._lock:
+            folder_id = self.folders.get(folder_name)
+            if folder_id:
+                return folder_id
+
+            folder_metadata = {
+                'name': folder_name,
+                'mimeType': FOLDER_MIME_TYPE,
+                'parents': [self.parent_id]
+            }
+            folder = self.service.files().create(body=folder_metadata, fields='id').execute()
+            logging.info(f"Folder '{folder_name}' created with ID: {folder['id']}")
+            self._add_folder(folder['id'], folder_name)
+            return folder['id']
+
+    def find_file(self, folder_id, name, md5=None, size=None):
+        """
+        Return the ID of an indexed file with this name in the folder, or None.
+        When `md5`/`size` are given they must match too.
+        """
+        with self._lock:
+            entry = self.files.get(folder_id, {}).get(name)
+        if entry is None:
+            return None
+        file_id, file_md5, file_size = entry
+        if md5 is not None and file_md5 != md5:
+            return None
+        if size is not None and file_size != size:
+            return None
+        return file_id
+
+    def add_file(self, folder_id, file_id, name, md5=None, size=0):
+        """
+        Record a file that was just uploaded.
+        """
+        with self._lock:
+            self.files.setdefault(folder_id, {})[name] = (file_id, md5, int(size))
+            self._paths[file_id] = (folder_id, name)
+
+    def save(self):
+        """
+        Write the index and changes page token to the snapshot file.
+        """
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            snapshot = {
+                'parent_id': self.parent_id,
+                'page_token': self.page_token,
+                'folders': self.folders,
+                'files': self.files
+            }
+            tmp_path = f'{self.snapshot_path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.snapshot_path)
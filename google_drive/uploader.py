@@ -0,0 +1,131 @@
+from google_drive.google_drive_client import authenticate_drive, build_upload_request, RESUMABLE_UPLOAD_THRESHOLD
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+from rate_limiter import get_limiter, parse_retry_after
+from metrics import UPLOADS, UPLOAD_LATENCY
+import threading
+import hashlib
+import logging
+import random
+import time
+import os
+
+
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+def is_retryable(error):
+    """
+    Return True for Drive errors worth retrying: 429, 5xx and 403 rate-limit responses.
+    """
+    status = error.resp.status
+    if status == 429 or status >= 500:
+        return True
+    if status == 403:
+        # error_details is a plain string when the response body is not structured JSON
+        return any(
+            isinstance(detail, dict) and detail.get('reason') in RATE_LIMIT_REASONS
+            for detail in (error.error_details or [])
+        )
+    return False
+
+
+class DriveUploader:
+    """
+    Concurrent Google Drive uploader.
+
+    Uploads run on a pool of `max_workers` threads, each with its own
+    authenticated Drive client (and therefore its own HTTP connection), because
+    the underlying httplib2 transport is not thread-safe. Files up to
+    `resumable_threshold` bytes use a single multipart request. Requests share
+    the process-wide Drive rate limiter, and rate-limit and server errors are
+    retried with jittered exponential backoff.
+    With a DriveNamespaceIndex, files already in the target folder with the same
+    name, MD5 and size are not uploaded again. `root_url` points the clients at
+    another Drive API root.
+    """
+
+    def __init__(self, cred_file, max_workers=4, resumable_threshold=RESUMABLE_UPLOAD_THRESHOLD,
+                 max_retries=5, backoff_base=1.0, backoff_max=64.0, index=None, root_url=None):
+        self.cred_file = cred_file
+        self.root_url = root_url
+        self.index = index
+        self.resumable_threshold = resumable_threshold
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='drive-upload')
+
+    def _service(self):
+        if getattr(self._local, 'service', None) is None:
+            self._local.service = authenticate_drive(self.cred_file, self.root_url)
+        return self._local.service
+
+    def upload(self, file_path, folder_id):
+        """
+        Upload one file on the calling thread, retrying transient errors.
+        Returns the Drive file ID, or None if the upload failed.
+        """
+        with UPLOAD_LATENCY.time():
+            file_id = self._upload(file_path, folder_id)
+        return file_id
+
+    def _upload(self, file_path, folder_id):
+        name = os.path.basename(file_path)
+        if self.index is not None:
+            with open(file_path, 'rb') as f:
+                md5 = hashlib.md5(f.read()).hexdigest()
+            existing_id = self.index.find_file(folder_id, name, md5, os.path.getsize(file_path))
+            if existing_id:
+                logging.info(f"File already on Drive, skipping upload: {file_path}")
+                UPLOADS.inc(result='existing')
+                return existing_id
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                request = build_upload_request(
+                    self._service(), file_path, folder_id, self.resumable_threshold, fields='id, md5Checksum, size'
+                )
+                with get_limiter('drive').slot() as permit:
+                    try:
+                        file = request.execute()
+                    except HttpError as e:
+                        # 403 rate-limit errors count as congestion like 429s
+                        permit.status = 429 if is_retryable(e) else e.resp.status
+                        permit.retry_after = parse_retry_after(e.resp.get('retry-after'))
+                        raise
+                logging.info(f"File uploaded successfully: {file_path}")
+                UPLOADS.inc(result='uploaded')
+                if self.index is not None:
+                    self.index.add_file(folder_id, file['id'], name, file.get('md5Checksum'), file.get('size', 0))
+                return file.get('id')
+            except HttpError as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    logging.error(f"Failed to upload file {file_path}: {e}")
+                    UPLOADS.inc(result='failed')
+                    return None
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+                logging.warning(f"Retrying upload of {file_path} in {delay:.1f}s after HTTP {e.resp.status}")
+                time.sleep(delay)
+            except Exception as e:
+                logging.error(f"Failed to upload file {file_path}: {e}")
+                UPLOADS.inc(result='failed')
+                return None
+
+    def submit(self, file_path, folder_id):
+        """
+        Queue an upload on the worker pool and return its Future.
+        """
+        return self._executor.submit(self.upload, file_path, folder_id)
+
+    def upload_many(self, file_paths, folder_id):
+        """
+        Upload files concurrently. Returns the file IDs in the same order as `file_paths`
+        (None for files that failed).
+        """
+        futures = [self.submit(file_path, folder_id) for file_path in file_paths]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,201 @@
+import hashlib
+import logging
+import shutil
+import threading
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# magic bytes -> (mime type, extension)
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', ('image/jpeg', 'jpg')),
+    (b'\x89PNG\r\n\x1a\n', ('image/png', 'png')),
+    (b'GIF87a', ('image/gif', 'gif')),
+    (b'GIF89a', ('image/gif', 'gif')),
+    (b'BM', ('image/bmp', 'bmp')),
+]
+
+
+def sniff_image_type(data):
+    """
+    Return (mime type, extension) for image bytes based on their signature, defaulting to JPEG.
+    """
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp', 'webp'
+    for signature, image_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return image_type
+    return 'image/jpeg', 'jpg'
+
+
+class ImageStore:
+    """
+    Content-addressed image store.
+
+    Images are keyed by the SHA-256 of their bytes and kept in a sharded layout
+    (`<base_dir>/ab/cd/<digest>.<ext>`) so no directory grows too large. Every
+    digest ever seen is recorded in an append-only index file, one
+    `<digest> <size> <ext>` line per image, which is loaded into memory on start.
+    Images can be registered without writing a blob, and digests stay in the
+    index after their blob is discarded, so an image that was already seen (and
+    rejected) is never processed again.
+
+    With `shared=True` several worker processes use the same store: lookups
+    first read the index lines other processes appended, and index lines are
+    appended under an exclusive lock on the index file.
+    """
+
+    def __init__(self, base_dir, index_name='index.txt', shared=False):
+        self.base_dir = base_dir
+        self.index_path = os.path.join(base_dir, index_name)
+        self.shared = shared
+        self._index = {}
+        self._offset = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        os.makedirs(base_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """
+        Load the on-disk index into memory.
+        """
+        self._refresh()
+        logging.info(f"Image store loaded {len(self._index)} entries from {self.index_path}")
+
+    def _refresh(self):
+        """
+        Read the complete index lines appended since the index was last read.
+        """
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            parts = line.split()
+            if len(parts) == 3:
+                self._index[parts[0]] = (int(parts[1]), parts[2])
+        self._offset += end
+
+    @staticmethod
+    def digest(data):
+        """
+        Return the hex SHA-256 digest of the image bytes.
+        """
+        return hashlib.sha256(data).hexdigest()
+
+    def __contains__(self, digest):
+        with self._lock:
+            if self.shared and digest not in self._index:
+                self._refresh()
+            return digest in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def path_for(self, digest, ext=None):
+        """
+        Return the sharded blob path for a digest.
+        """
+        if ext is None:
+            ext = self._index.get(digest, (0, 'jpg'))[1]
+        return os.path.join(self.base_dir, digest[:2], digest[2:4], f'{digest}.{ext}')
+
+    def _append(self, lines):
+        with open(self.index_path, 'a') as f:
+            if self.shared and fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(''.join(lines))
+
+    def register(self, data, ext=None, defer=False):
+        """
+        Index image bytes without writing them. Returns (digest, is_new); is_new
+        is False when the digest was already indexed. With `defer=True` the index
+        line is only appended to the file by the next `flush`.
+        """
+        digest = self.digest(data)
+        if ext is None:
+            ext = sniff_image_type(data)[1]
+        with self._lock:
+            if self.shared and digest not in self._index:
+                self._refresh()
+            if digest in self._index:
+                return digest, False
+
+            self._index[digest] = (len(data), ext)
+            line = f'{digest} {len(data)} {ext}\n'
+            if defer:
+                self._pending.append(line)
+            else:
+                self._append([line])
+
+        return digest, True
+
+    def flush(self):
+        """
+        Append the index lines of deferred registrations to the index file.
+        """
+        with self._lock:
+            lines, self._pending = self._pending, []
+            if lines:
+                self._append(lines)
+
+    def write(self, digest, data):
+        """
+        Write the blob for an indexed digest and return its path.
+        """
+        path = self.path_for(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def read(self, digest):
+        """
+        Return the stored bytes for a digest, or None if no blob was written.
+        """
+        try:
+            with open(self.path_for(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, data, ext=None):
+        """
+        Index and write image bytes. Returns (digest, path, is_new); when the
+        digest is already indexed nothing is written and is_new is False.
+        """
+        digest, is_new = self.register(data, ext)
+        if not is_new:
+            return digest, self.path_for(digest), False
+        return digest, self.write(digest, data), True
+
+    def discard(self, digest):
+        """
+        Remove the blob for a digest but keep it indexed as seen.
+        """
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def link(self, digest, folder_path):
+        """
+        Expose a stored image inside a label folder as `<digest>.<ext>`.
+        Uses a hard link where possible and falls back to a copy.
+        """
+        source_path = self.path_for(digest)
+        target_path = os.path.join(folder_path, os.path.basename(source_path))
+        if not os.path.exists(target_path):
+            try:
+                os.link(source_path, target_path)
+            except OSError:
+                shutil.copyfile(source_path, target_path)
+        return target_path
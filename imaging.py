@@ -0,0 +1,25 @@
+import io
+
+
+def decode_for_scoring(image_data, max_edge=512):
+    """
+    Decode image bytes in whatever format they really are and downscale them so
+    the longest edge is at most `max_edge`. Returns the original (width, height)
+    and the downscaled RGB image. Raises if the bytes cannot be decoded.
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_data)) as image:
+        size = image.size
+        # lets the JPEG decoder downscale while decoding
+        image.draft('RGB', (max_edge, max_edge))
+        image = image.convert('RGB')
+    image.thumbnail((max_edge, max_edge))
+    return size, image
+
+
+def encode_jpeg(image, quality=85):
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality)
+    return output.getvalue()
+
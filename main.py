@@ -1,8 +1,16 @@
 from google_drive.google_drive_client import authenticate_drive, get_or_create_gd_folder, upload_file
+from image_store import ImageStore
+from serp_cache import SerpCache
+from serp_parser import ImagesExtractor, images_from_json, images_to_json
+from verdict_cache import VerdictCache
+from run_results import ResultsWriter
+from rate_limiter import get_limiter, parse_retry_after
+from request_policy import RequestPolicy, RequestFailed
+from sheet_loader import load_sheet, extract_keywords_plagas, extract_keywords_defici, PLAGAS_KEYWORD_COLUMNS, DEFICI_KEYWORDS
+from query_templates import QueryTemplates
 import google.generativeai as genai
 from dotenv import load_dotenv
 from urllib.parse import quote
-import pandas as pd
 import requests
 import base64
 import logging
@@ -19,6 +27,30 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 current_directory = os.getcwd()
 image_base_dir = os.path.join(current_directory, 'Images')
 os.makedirs(image_base_dir, exist_ok=True)
+image_store_dir = os.path.join(image_base_dir, 'store')
+verdict_cache_path = os.path.join(image_base_dir, 'verdicts.sqlite')
+serp_cache_dir = os.path.join(current_directory, 'serp_cache')
+sheet_cache_dir = os.path.join(current_directory, 'sheet_cache')
+run_results_path = os.path.join(current_directory, 'run_results.jsonl')
+
+# settings (read from the environment / .env)
+load_dotenv()
+
+# SERP cache settings
+serp_cache_ttl = int(os.getenv('serp_cache_ttl', 7 * 24 * 3600))
+serp_cache_max_bytes = int(os.getenv('serp_cache_max_bytes', 2 * 1024 ** 3))
+serp_chunk_size = int(os.getenv('serp_chunk_size', 64 * 1024))
+
+# SERP request policy settings
+serp_attempt_timeout = float(os.getenv('serp_attempt_timeout', 30))
+serp_total_timeout = float(os.getenv('serp_total_timeout', 120))
+serp_max_retries = int(os.getenv('serp_max_retries', 3))
+serp_hedge = os.getenv('serp_hedge', '1') == '1'
+serp_hedge_quantile = float(os.getenv('serp_hedge_quantile', 0.95))
+
+# relevance settings
+relevance_threshold = int(os.getenv('relevance_threshold', 7))
+verdict_cache_ttl = int(os.getenv('verdict_cache_ttl', 30 * 24 * 3600))
 
 
 master_queries_for_plagas = [
@@ -39,9 +71,13 @@ master_queries_for_Deficiencias = [
     "Vista detallada de [disorder] con [characteristic] afectando [affected_part]",
     "Imágenes de alta resolución de [disorder] y [characteristic] en [affected_part]",
     "[disorder] causando [characteristic] en [affected_part]",
-    "Signos visibles de [Disorder] - [Characteristic] en [affected_part]",
+    "Signos visibles de [disorder] - [characteristic] en [affected_part]",
 ]
 
+# compiled once; a template with an unknown placeholder fails here, at import
+plagas_query_templates = QueryTemplates(master_queries_for_plagas, PLAGAS_KEYWORD_COLUMNS.values())
+defici_query_templates = QueryTemplates(master_queries_for_Deficiencias, DEFICI_KEYWORDS)
+
 
 def get_or_create_folder( folder_name, base_dir=image_base_dir):
     """
@@ -55,17 +91,10 @@ def get_or_create_folder( folder_name, base_dir=image_base_dir):
 
 def load_excel_data(excel_file, sheet_name):
     """
-    Load and preprocess the Excel data.
+    Load and preprocess the Excel data, from its cached snapshot when the workbook is unchanged.
     """
     try:
-        data = pd.read_excel(excel_file, header=1, sheet_name=sheet_name)
-        if sheet_name == 'Plagas':
-            data = data.drop(data.columns[:2], axis=1).reset_index(drop=True)
-        elif sheet_name == 'Deficiencias':
-            data.rename(columns={data.columns[0]: 'disorders'}, inplace=True)
-        else:
-            raise ValueError(f"Sheet name '{sheet_name}' not recognized.")
-        return data
+        return load_sheet(excel_file, sheet_name, cache_dir=sheet_cache_dir)
     except FileNotFoundError:
         logging.error(f"File {excel_file} not found.")
         return None
@@ -74,68 +103,6 @@ def load_excel_data(excel_file, sheet_name):
         return None
 
 
-def extract_keywords_plagas(df_row):
-    """
-    Extracts keywords for search query from pandas dataframe row.
-    """
-    disease_type = df_row["Tipo"]
-    # print(f'index: {index} \ntype: {disease_type}')
-
-    sub_type = df_row["Subtipo"]
-    # print(f'subtype: {sub_type}')
-
-    common_name = df_row["Nombre Común"]
-    # print(f'common name: {common_name}')
-
-    scientific_name = df_row["Nombre Científico"]
-    # print(f'scientific name: {scientific_name}')
-
-    affected_part = df_row["Parte Afectada"] if not pd.isna(df_row["Parte Afectada"]) else 'plant body'
-    # print(f'affected part: {affected_part}')
-
-    affected_species = df_row["Especie Afectada"] if not pd.isna(df_row["Especie Afectada"])  else 'citrus plant'
-    # print(f'affected_species: {affected_species}')
-
-    damage = df_row["Daño"] if not pd.isna(df_row["Daño"]) else 'damage'
-    # print(f'damage: {damage} \n')
-
-    keyword_data = {
-        "Tipo": disease_type,
-        'Subtipo': sub_type,
-        'nombre_común': common_name,
-        'Nombre Científico': scientific_name,
-        'parte_afectada': affected_part,
-        'especies_afectadas': affected_species,
-        'Daño': damage
-    }
-
-    return keyword_data
-
-
-def extract_keywords_defici(disorder, row):
-    """
-    Extract keywords specific to 'Deficiencias' from the data row.
-    """
-    return {
-        'disorder': disorder,
-        'characteristic': row["Característica"],
-        'affected_part': row["Parte Afectada"] or 'plant body'
-    }
-
-
-def generate_queries(query_templates, keywords):
-    """
-    Generate search queries based on templates and keywords.
-    """
-    queries = []
-    for template in query_templates:
-        query = template
-        for key, value in keywords.items():
-            query = query.replace(f'[{key}]', value)
-        queries.append(query)
-    return queries
-
-
 # def generate_queries(keywords):
 #     """
 #     Generate search queries based on keywords.
@@ -180,28 +147,81 @@ def generate_queries(query_templates, keywords):
 #         return None
 
 
-def get_search_results(queries, proxies):
+search_params = {
+    'gl': 'es',
+    'tbm': 'isch',
+    'num': 100,
+    'location': 'Spain',
+    'uule': 'w+CAIQICIFU3BhaW4',
+    'brd_json': 1
+}
+
+
+def build_search_url(query, params=search_params):
+    """
+    Build the Google Images search URL for a query.
+    """
+    extra = '&'.join(f'{key}={value}' for key, value in params.items())
+    return f'https://www.google.es/search?q={quote(query)}&{extra}'
+
+
+serp_policy = RequestPolicy(
+    'serp',
+    attempt_timeout=serp_attempt_timeout,
+    total_timeout=serp_total_timeout,
+    max_retries=serp_max_retries,
+    hedge=serp_hedge,
+    hedge_quantile=serp_hedge_quantile
+)
+
+
+def fetch_serp_images(url, proxies):
+    """
+    One SERP request. Only the image records are parsed out of the response, as it streams in.
+    Requests go through the shared SERP rate limiter, which backs off on 429/5xx
+    responses and honours Retry-After.
+    """
+    with get_limiter('serp').slot() as permit:
+        with requests.get(url, proxies=proxies, verify=False, stream=True, timeout=serp_attempt_timeout) as response:
+            permit.status = response.status_code
+            permit.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if response.status_code != 200:
+                raise RequestFailed(response.status_code, permit.retry_after)
+            extractor = ImagesExtractor()
+            for chunk in response.iter_content(chunk_size=serp_chunk_size):
+                extractor.feed(chunk)
+            return extractor.images
+
+
+def get_search_results(queries, proxies, cache=None):
     """
     Retrieve SERP results for all queries
+    Returns one list of SerpImage records per query. Cached responses are returned
+    without touching the proxy; other queries are fetched under `serp_policy`,
+    which bounds each attempt and the whole query with timeouts, retries with
+    backoff and hedges slow requests.
     """
     results = []
 
     for query in queries:
 
-        url = f'https://www.google.es/search?q={quote(query)}&gl=es&tbm=isch&num=100&location=Spain&uule=w+CAIQICIFU3BhaW4&brd_json=1'
-        try:
-            response = requests.get(url, proxies=proxies, verify=False)
-            response.raise_for_status()
+        if cache is not None:
+            cached = cache.get(query, search_params)
+            if cached is not None:
+                logging.info(f"Using cached data for {query}")
+                results.append(images_from_json(cached))
+                continue
 
-            if response.status_code == 200:
-                results.append(response.json())
+        url = build_search_url(query)
+        try:
+            images = serp_policy.call(fetch_serp_images, url, proxies)
+            if cache is not None:
+                cache.put(query, search_params, images_to_json(images))
+            results.append(images)
         except Exception as e:
             logging.error(f"Error fetching data from {url}: {e}")
             print(f"Error while fetching data from {url}: {e}" )
 
-    with open('response.json', 'w') as f:
-        json.dump(results, f, indent=4)
-
     return results
 
 
@@ -209,75 +229,98 @@ def get_unique_image_urls(results: list) -> set:
     """
     Extract unique image URLs from SERP results.
     """
-    image_urls = {image['image'] for query_result in results for image in query_result.get('images', [])}
+    image_urls = {image.image for query_result in results for image in query_result}
 
     return image_urls
 
 
-def save_image(image_url, file_path):
+def save_image(store, image_url):
     """
-    Save image to file from a URL or base64 encoded data.
+    Save image to the content-addressed store from a URL or base64 encoded data.
+    Returns (digest, path) for new images and None for duplicates or failures.
     """
     try:
         if image_url.startswith("data:image"):
             image_data = base64.b64decode(image_url.split(',')[1])
-            with open(file_path, 'wb') as img_file:
-                img_file.write(image_data)
         else:
             response = requests.get(image_url, stream=True)
             response.raise_for_status()
-            with open(file_path, 'wb') as img_file:
-                img_file.write(response.content)
+            image_data = response.content
+
+        digest, file_path, is_new = store.put(image_data)
+        if not is_new:
+            logging.info(f"Duplicate image skipped: {digest}")
+            return None
 
         logging.info(f"Image saved at: {file_path}")
+        return digest, file_path
     except Exception as e:
-        logging.error(f"Error saving image from {image_url}: {e}")
-        print(f"Error saving image from {image_url}: {e}")
+        logging.error(f"Error saving image from {image_url[:100]}: {e}")
+        print(f"Error saving image from {image_url[:100]}: {e}")
+        return None
+
 
+def is_relevant(score, verdict):
+    """
+    Apply the relevance threshold to a Gemini score and verdict.
+    """
+    return score > relevance_threshold and verdict == "Y"
 
-def check_image_relevance(model, prompt, image_path):
+
+def check_image_relevance(model, prompt, image_path, digest=None, cache=None):
     """
     Check relevancy of an image based on keywords using Gemini.
+    Verdicts are looked up in and saved to `cache` when the image digest is known.
+    Returns None when the image could not be scored, so it is not mistaken for an
+    irrelevant one.
     """
+    if cache is not None and digest is not None:
+        cached = cache.get(digest, prompt)
+        if cached is not None:
+            logging.info(f"Cached verdict for {image_path}: {cached}")
+            return is_relevant(*cached)
+
     try:
         myfile = genai.upload_file(image_path)
         # print(f"{myfile=}")
 
-        result = model.generate_content([myfile, prompt])
+        result = get_limiter('gemini').call(model.generate_content, [myfile, prompt])
         # print(f"{result.text=}")
         response_json = json.loads(result.text)
 
-        return int(response_json.get("score_1_to_10", 0)) > 7 and response_json.get("Final_Verdict") == "Y"
+        score = int(response_json.get("score_1_to_10", 0))
+        verdict = response_json.get("Final_Verdict")
+        if cache is not None and digest is not None:
+            cache.put(digest, prompt, score, verdict)
+
+        return is_relevant(score, verdict)
     except Exception as e:
         logging.error(f"Error checking image relevance for {image_path}: {e}")
         print(f"Error checking image relevance for {image_path}: {e}")
-        return False
+        return None
 
 
-def extract_pagas_excel_data(df, proxies, model, drive, parent_id):
+def extract_pagas_excel_data(serp_cache, store, df, proxies, model, verdict_cache, drive, parent_id, results):
     """
     Extract data from Excel, perform search, and save images.
+    Per-image outcomes are appended to `results` after every row.
     """
+    keyword_table = extract_keywords_plagas(df.iloc[4:5])
+    all_queries = plagas_query_templates.expand_table(keyword_table)
+    for row_index, keywords, queries in zip(keyword_table.index, keyword_table.to_dict('records'), all_queries):
 
-    data_set = {}
-    data = []
-    for _, row in df.iloc[4:5].iterrows():
-
-        keywords = extract_keywords_plagas(row)
-        queries = generate_queries(master_queries_for_plagas, keywords)
-        search_result = get_search_results(queries, proxies)
+        search_result = get_search_results(queries, proxies, serp_cache)
 
         unique_image_urls = get_unique_image_urls(search_result)
-        image_folder_path = get_or_create_folder(row["Nombre Científico"])
-        # drive_image_folder_id = get_or_create_gd_folder(drive, row["Tipo"], parent_id=parent_id)
+        image_folder_path = get_or_create_folder(keywords["Nombre Científico"])
+        # drive_image_folder_id = get_or_create_gd_folder(drive, keywords["Tipo"], parent_id=parent_id)
 
-        for count, image_url in enumerate(unique_image_urls):
+        for image_url in unique_image_urls:
 
-            image_file_path = os.path.join(
-                image_folder_path,
-                f'{row["Nombre Científico"]}_image_{count}.jpg'
-                )
-            save_image(image_url, image_file_path)
+            saved_image = save_image(store, image_url)
+            if saved_image is None:
+                continue
+            digest, image_file_path = saved_image
 
             prompt = f"""Please tell me whether the image given is of this or not check thourghly ,
                     common name: {keywords['nombre_común']}
@@ -289,52 +332,47 @@ def extract_pagas_excel_data(df, proxies, model, drive, parent_id):
                     "Final_Verdict":"Y/N"
                     }}"""
 
-            if check_image_relevance(model, prompt, image_file_path):
-                # upload_file(drive, image_file_path, drive_image_folder_id)
-                pass
+            relevant = check_image_relevance(model, prompt, image_file_path, digest, verdict_cache)
+            if relevant:
+                # the baseline kept accepted Plagas images in their label folder without uploading them
+                store.link(digest, image_folder_path)
+                results.add('Plagas', int(row_index), image_url, digest, 'accepted')
+            elif relevant is None:
+                logging.warning(f"Image kept unscored, Gemini could not score it: {image_file_path}")
+                results.add('Plagas', int(row_index), image_url, digest, 'unscored')
             else:
-                os.remove(image_file_path)
+                store.discard(digest)
                 logging.info(f"Irrelevant image removed: {image_file_path}")
                 print(f"Irrelevant image removed: {image_file_path}")
+                results.add('Plagas', int(row_index), image_url, digest, 'rejected')
 
-        data_set[row["Nombre Científico"]] = search_result
-        data.append(data_set)
-
+        results.flush()
 
-    return data
 
-
-def extract_defici_excel_data(df, proxies, model, drive, parent_id):
+def extract_defici_excel_data(serp_cache, store, df, proxies, model, verdict_cache, drive, parent_id, results):
     """
     Extract data from Excel, perform search, and save images for deficiency.
+    Per-image outcomes are appended to `results` after every row.
     """
-    current_disorder = None
+    keyword_table = extract_keywords_defici(df)
+    all_queries = defici_query_templates.expand_table(keyword_table)
+    for row_index, keywords, queries in zip(keyword_table.index, keyword_table.to_dict('records'), all_queries):
 
-    for _, row in df.iterrows():
+        current_disorder = keywords['disorder']
+        search_result = get_search_results(queries, proxies, serp_cache)
 
-        if pd.isna(row["Característica"]):
-            current_disorder = row["disorders"]
-        else:
-            keywords = {
-                'characteristic': row["Característica"],
-                'affected_part': row["Parte Afectada"]
-            }
-            queries = generate_queries(master_queries_for_Deficiencias, keywords)
-            search_result = get_search_results(queries, proxies)
-
-            unique_image_urls = get_unique_image_urls(search_result)
-            image_folder_path = get_or_create_folder(current_disorder)
-            drive_image_folder_id = get_or_create_gd_folder(drive, current_disorder, parent_id=parent_id)
-
-            for count, image_url in enumerate(unique_image_urls):
-
-                image_file_path = os.path.join(
-                    image_folder_path,
-                    f'{current_disorder}_image_{count}.jpg'
-                    )
-                save_image(image_url, image_file_path)
-
-                prompt = f"""Please tell me whether the image given is of this or not check thourghly ,
+        unique_image_urls = get_unique_image_urls(search_result)
+        image_folder_path = get_or_create_folder(current_disorder)
+        drive_image_folder_id = get_or_create_gd_folder(drive, current_disorder, parent_id=parent_id)
+
+        for image_url in unique_image_urls:
+
+            saved_image = save_image(store, image_url)
+            if saved_image is None:
+                continue
+            digest, image_file_path = saved_image
+
+            prompt = f"""Please tell me whether the image given is of this or not check thourghly ,
                     characteristics: {keywords['characteristic']}
                     disorder: {current_disorder}
                     Based on your assessment give relevancy score on the scale of 1 to 10."
@@ -344,11 +382,21 @@ def extract_defici_excel_data(df, proxies, model, drive, parent_id):
                     "Final_Verdict":"Y/N"
                     }}"""
 
-                if check_image_relevance(model, prompt, image_file_path):
-                    upload_file(drive, image_file_path, drive_image_folder_id)
-                else:
-                    logging.info(f"Irrelevant image removed: {image_file_path}")
-                    print(f"Irrelevant image removed: {image_file_path}")
+            relevant = check_image_relevance(model, prompt, image_file_path, digest, verdict_cache)
+            if relevant:
+                labelled_file_path = store.link(digest, image_folder_path)
+                file_id = upload_file(drive, labelled_file_path, drive_image_folder_id)
+                results.add('Deficiencias', int(row_index), image_url, digest, 'accepted', drive_id=file_id)
+            elif relevant is None:
+                logging.warning(f"Image kept unscored, Gemini could not score it: {image_file_path}")
+                results.add('Deficiencias', int(row_index), image_url, digest, 'unscored')
+            else:
+                store.discard(digest)
+                logging.info(f"Irrelevant image removed: {image_file_path}")
+                print(f"Irrelevant image removed: {image_file_path}")
+                results.add('Deficiencias', int(row_index), image_url, digest, 'rejected')
+
+        results.flush()
 
 
 if __name__ == '__main__':
@@ -384,11 +432,15 @@ if __name__ == '__main__':
     parent_folder_id = os.getenv('google_drive_parent_folder_id')
 
     excel_file = os.path.join(current_directory,'Indice de Entrenamiento- Citricos (2).xlsx')
+    serp_cache = SerpCache(serp_cache_dir, ttl=serp_cache_ttl, max_bytes=serp_cache_max_bytes)
+    store = ImageStore(image_store_dir)
+    verdict_cache = VerdictCache(verdict_cache_path, model.model_name, ttl=verdict_cache_ttl)
+    results = ResultsWriter(run_results_path)
+
     plagas_excel_data = load_excel_data(excel_file,sheet_name='Plagas')
-    data = extract_pagas_excel_data(plagas_excel_data, proxies, model, drive_service, parent_folder_id)
+    extract_pagas_excel_data(serp_cache, store, plagas_excel_data, proxies, model, verdict_cache, drive_service, parent_folder_id, results)
 
     # defici_excel_data = load_excel_data(excel_file,sheet_name='Deficiencias')
-    # extract_defici_excel_data(defici_excel_data, proxies, model, drive_service, parent_folder_id)
+    # extract_defici_excel_data(serp_cache, store, defici_excel_data, proxies, model, verdict_cache, drive_service, parent_folder_id, results)
 
-    # with open("new_data.json", 'w') as f:
-    #     json.dump(data, f, indent=4)
+    results.close()
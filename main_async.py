@@ -1,16 +1,35 @@
-from google_drive.google_drive_client import authenticate_drive, get_or_create_gd_folder, upload_file
-import google.generativeai as genai
+from image_store import ImageStore, sniff_image_type
+from serp_cache import SerpCache
+from serp_parser import ImagesExtractor, images_from_json, images_to_json, page_starts
+from run_journal import RunJournal, image_key
+from verdict_cache import VerdictCache
+from url_index import SeenUrlIndex, canonicalize_url
+from prefilter import PrefilterConfig, screen_image
+from rate_limiter import RETRYABLE_STATUSES, error_status, get_limiter, parse_retry_after, set_process_share
+from request_policy import RequestPolicy, RequestFailed
+from work_queue import WorkQueue
+from sheet_loader import load_sheet, extract_keywords_plagas, extract_keywords_defici, PLAGAS_KEYWORD_COLUMNS, DEFICI_KEYWORDS
+from query_templates import QueryTemplates
+from dataset_export import ShardWriter, export_accepted
+from run_results import ResultsWriter
+from metrics import (
+    MetricsExporter, registry, SERP_QUERIES, SERP_PAGES, SERP_LATENCY, URLS_SKIPPED, IMAGES_DOWNLOADED, IMAGE_BYTES, DOWNLOAD_LATENCY,
+    VERDICTS, PREFILTER_REJECTIONS, RELEVANCE_LATENCY, ROWS_FINISHED, IN_FLIGHT, ROWS_IN_FLIGHT
+)
+from contextlib import asynccontextmanager, AsyncExitStack
 from dotenv import load_dotenv
 from urllib.parse import quote
-import pandas as pd
-import requests
 import base64
+import io
 import logging
 import json
 import ssl
 import os
+import socket
 import asyncio
-import aiohttp
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
 ssl._create_default_https_context = ssl._create_unverified_context
@@ -19,6 +38,18 @@ ssl._create_default_https_context = ssl._create_unverified_context
 current_directory = os.getcwd()
 image_base_dir = os.path.join(current_directory, 'Images')
 os.makedirs(image_base_dir, exist_ok=True)
+image_store_dir = os.path.join(image_base_dir, 'store')
+verdict_cache_path = os.path.join(image_base_dir, 'verdicts.sqlite')
+serp_cache_dir = os.path.join(current_directory, 'serp_cache')
+run_journal_path = os.path.join(current_directory, 'run_journal.jsonl')
+run_results_path = os.path.join(current_directory, 'run_results.jsonl')
+drive_index_path = os.path.join(current_directory, 'drive_index.json')
+service_account_creds = os.path.join(current_directory, 'service_account.json')
+excel_file = os.path.join(current_directory, 'Indice de Entrenamiento- Citricos (2).xlsx')
+work_queue_path = os.path.join(current_directory, 'work_queue.sqlite')
+seen_urls_path = os.path.join(current_directory, 'seen_urls.sqlite')
+sheet_cache_dir = os.path.join(current_directory, 'sheet_cache')
+dataset_dir = os.path.join(current_directory, 'dataset')
 
 # Log directory
 log_directory = os.path.join(current_directory, 'logs')
@@ -37,6 +68,102 @@ logging.basicConfig(
     ]
 )
 
+# settings (read from the environment / .env)
+load_dotenv()
+
+# download settings
+download_concurrency = int(os.getenv('download_concurrency', 32))
+connection_limit = int(os.getenv('connection_limit', 100))
+connection_limit_per_host = int(os.getenv('connection_limit_per_host', 8))
+dns_cache_ttl = int(os.getenv('dns_cache_ttl', 300))
+keepalive_timeout = int(os.getenv('keepalive_timeout', 30))
+download_timeout = int(os.getenv('download_timeout', 30))
+serp_chunk_size = int(os.getenv('serp_chunk_size', 64 * 1024))
+# SERP endpoint, e.g. a local stand-in for benchmarks
+serp_search_url = os.getenv('serp_search_url', 'https://www.google.es/search')
+# SERP pagination: result pages to harvest per query (1 = first page only) and
+# how many further pages are fetched at once
+serp_max_pages = int(os.getenv('serp_max_pages', 1))
+serp_page_concurrency = int(os.getenv('serp_page_concurrency', 3))
+# Gemini API endpoint and Drive API root URL, e.g. local stand-ins for benchmarks (empty = Google's)
+gemini_api_endpoint = os.getenv('gemini_api_endpoint', '')
+drive_root_url = os.getenv('drive_root_url', '')
+
+# SERP request policy settings
+serp_attempt_timeout = float(os.getenv('serp_attempt_timeout', 30))
+serp_total_timeout = float(os.getenv('serp_total_timeout', 120))
+serp_max_retries = int(os.getenv('serp_max_retries', 3))
+serp_hedge = os.getenv('serp_hedge', '1') == '1'
+serp_hedge_quantile = float(os.getenv('serp_hedge_quantile', 0.95))
+
+# SERP cache settings
+serp_cache_ttl = int(os.getenv('serp_cache_ttl', 7 * 24 * 3600))
+serp_cache_max_bytes = int(os.getenv('serp_cache_max_bytes', 2 * 1024 ** 3))
+
+# run journal settings
+journal_flush_every = int(os.getenv('journal_flush_every', 50))
+
+# pipeline settings
+search_workers = int(os.getenv('search_workers', 2))
+download_workers = int(os.getenv('download_workers', 2))
+score_workers = int(os.getenv('score_workers', 4))
+upload_workers = int(os.getenv('upload_workers', 4))
+pipeline_queue_size = int(os.getenv('pipeline_queue_size', 8))
+max_rows_in_flight = int(os.getenv('max_rows_in_flight', 4))
+
+# work queue settings: with more than one worker process (or join_queue=1 on
+# additional machines sharing the queue file) rows are distributed through the queue
+worker_processes = int(os.getenv('worker_processes', 1))
+join_queue = os.getenv('join_queue', '0') == '1'
+lease_seconds = int(os.getenv('lease_seconds', 600))
+max_task_attempts = int(os.getenv('max_task_attempts', 3))
+queue_poll_interval = float(os.getenv('queue_poll_interval', 5))
+
+# metrics settings: serve Prometheus metrics on metrics_port (0 = off) and/or
+# write them to metrics_file every metrics_interval seconds; worker processes
+# use the following ports and number their files
+metrics_port = int(os.getenv('metrics_port', 0))
+metrics_file = os.getenv('metrics_file', '')
+metrics_interval = float(os.getenv('metrics_interval', 15))
+
+# dataset export settings
+dataset_shard_bytes = int(os.getenv('dataset_shard_bytes', 1024 ** 3))
+dataset_shard_samples = int(os.getenv('dataset_shard_samples', 10000))
+
+# scoring image settings
+scoring_max_edge = int(os.getenv('scoring_max_edge', 512))
+scoring_quality = int(os.getenv('scoring_quality', 85))
+normalize_workers = int(os.getenv('normalize_workers', 2))
+# image processes per machine; queue workers on one machine split them
+normalize_processes = int(os.getenv('normalize_processes', os.cpu_count() or 1))
+# worker processes sharing this machine (set by run_worker)
+_local_processes = 1
+
+# pre-filter settings: cheap local checks that reject junk before it reaches Gemini.
+# prefilter_checks is a comma-separated list (empty = off); 'onnx' is added when
+# prefilter_onnx_model points at a classifier. prefilter_plugins lists modules
+# that register extra checks.
+prefilter_onnx_model = os.getenv('prefilter_onnx_model', '')
+prefilter_config = PrefilterConfig(
+    checks=[name for name in os.getenv('prefilter_checks', 'file_size,resolution,aspect_ratio,blank').split(',') if name]
+    + (['onnx'] if prefilter_onnx_model else []),
+    min_bytes=int(os.getenv('prefilter_min_bytes', 1024)),
+    max_bytes=int(os.getenv('prefilter_max_bytes', 25 * 1024 ** 2)),
+    min_side=int(os.getenv('prefilter_min_side', 96)),
+    max_aspect=float(os.getenv('prefilter_max_aspect', 4.0)),
+    min_entropy=float(os.getenv('prefilter_min_entropy', 2.0)),
+    onnx_model=prefilter_onnx_model or None,
+    onnx_threshold=float(os.getenv('prefilter_onnx_threshold', 0.5)),
+    onnx_input_size=int(os.getenv('prefilter_onnx_input_size', 224)),
+    plugins=[name for name in os.getenv('prefilter_plugins', '').split(',') if name]
+)
+
+# relevance settings
+relevance_threshold = int(os.getenv('relevance_threshold', 7))
+verdict_cache_ttl = int(os.getenv('verdict_cache_ttl', 30 * 24 * 3600))
+relevance_batch_size = int(os.getenv('relevance_batch_size', 10))
+inline_image_limit = int(os.getenv('inline_image_limit', 4 * 1024 * 1024))
+
 
 master_queries_for_plagas = [
     '[nombre_común] en plantas de [especies_afectadas] - [Subtipo] ([Nombre Científico]) en [parte_afectada]. El daño visible incluye [Daño]',
@@ -66,9 +193,13 @@ master_queries_for_Deficiencias = [
     "Vista detallada de [disorder] con [characteristic] afectando [affected_part]",
     "Imágenes de alta resolución de [disorder] y [characteristic] en [affected_part]",
     "[disorder] causando [characteristic] en [affected_part]",
-    "Signos visibles de [Disorder] - [Characteristic] en [affected_part]",
+    "Signos visibles de [disorder] - [characteristic] en [affected_part]",
 ]
 
+# compiled once; a template with an unknown placeholder fails here, at import
+plagas_query_templates = QueryTemplates(master_queries_for_plagas, PLAGAS_KEYWORD_COLUMNS.values())
+defici_query_templates = QueryTemplates(master_queries_for_Deficiencias, DEFICI_KEYWORDS)
+
 
 async def get_or_create_folder( folder_name, base_dir=image_base_dir):
     """
@@ -80,19 +211,12 @@ async def get_or_create_folder( folder_name, base_dir=image_base_dir):
     return image_folder_path
 
 
-async def load_excel_data(excel_file, sheet_name):
+def load_excel_data(excel_file, sheet_name):
     """
-    Load and preprocess the Excel data.
+    Load and preprocess the Excel data, from its cached snapshot when the workbook is unchanged.
     """
     try:
-        data = pd.read_excel(excel_file, header=1, sheet_name=sheet_name)
-        if sheet_name == 'Plagas':
-            data = data.drop(data.columns[:2], axis=1).reset_index(drop=True)
-        elif sheet_name == 'Deficiencias':
-            data.rename(columns={data.columns[0]: 'disorders'}, inplace=True)
-        else:
-            raise ValueError(f"Sheet name '{sheet_name}' not recognized.")
-        return data
+        return load_sheet(excel_file, sheet_name, cache_dir=sheet_cache_dir)
     except FileNotFoundError:
         logging.error(f"File {excel_file} not found.")
         return None
@@ -101,302 +225,1264 @@ async def load_excel_data(excel_file, sheet_name):
         return None
 
 
-async def extract_keywords_plagas(df_row):
-    """
-    Extracts keywords for search query from pandas dataframe row.
-    """
-    disease_type = df_row["Tipo"]
-    # print(f'index: {index} \ntype: {disease_type}')
+# async def generate_queries(keywords):
+#     """
+#     Generate search queries based on keywords.
+#     """
+#     queries = []
+#     for query in master_queries:
+#         result = query.replace('[nombre_común]', keywords['common_name'])
+#         result = result.replace('[especies_afectadas]', keywords['affected_species'])
+#         result = result.replace('[Subtipo]', keywords['sub_type'])
+#         result = result.replace('[Nombre Científico]', keywords['scientific_name'])
+#         result = result.replace('[parte_afectada]', keywords['affected_part'])
+#         result = result.replace('[Daño]', keywords['damage'])
 
-    sub_type = df_row["Subtipo"]
-    # print(f'subtype: {sub_type}')
+#         result = ' '.join(result.split())
+#         queries.append(result)
 
-    common_name = df_row["Nombre Común"]
-    # print(f'common name: {common_name}')
+#     return queries
 
-    scientific_name = df_row["Nombre Científico"]
-    # print(f'scientific name: {scientific_name}')
 
-    affected_part = df_row["Parte Afectada"] if not pd.isna(df_row["Parte Afectada"]) else 'plant body'
-    # print(f'affected part: {affected_part}')
+search_params = {
+    'gl': 'es',
+    'tbm': 'isch',
+    'num': 100,
+    'location': 'Spain',
+    'uule': 'w+CAIQICIFU3BhaW4',
+    'brd_json': 1
+}
+# the result set also depends on the pages harvested, so that is part of the cache key
+serp_result_params = dict(search_params, max_pages=serp_max_pages) if serp_max_pages > 1 else search_params
 
-    affected_species = df_row["Especie Afectada"] if not pd.isna(df_row["Especie Afectada"])  else 'citrus plant'
-    # print(f'affected_species: {affected_species}')
 
-    damage = df_row["Daño"] if not pd.isna(df_row["Daño"]) else 'damage'
-    # print(f'damage: {damage} \n')
+# Heavy SDKs (aiohttp, google-generativeai, the Drive client) are imported and
+# set up on first use and then kept for the life of the process, so commands
+# that do not need them never pay for them. The lock is reentrant because some
+# factories build the clients they depend on (the uploader needs the Drive index,
+# which needs the Drive service).
+_clients = {}
+_clients_lock = threading.RLock()
 
-    keyword_data = {
-        "Tipo": disease_type,
-        'Subtipo': sub_type,
-        'nombre_común': common_name,
-        'Nombre Científico': scientific_name,
-        'parte_afectada': affected_part,
-        'especies_afectadas': affected_species,
-        'Daño': damage
-    }
 
-    return keyword_data
+def _client(name, factory):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
 
 
-async def extract_keywords_defici(disorder, row):
+def get_serp_policy():
     """
-    Extract keywords specific to 'Deficiencias' from the data row.
+    Timeouts, retries and hedging for SERP requests.
     """
-    return {
-        'disorder': disorder,
-        'characteristic': row["Característica"],
-        'affected_part': row["Parte Afectada"] or 'plant body'
-    }
+    def create():
+        import aiohttp
+        return RequestPolicy(
+            'serp',
+            attempt_timeout=serp_attempt_timeout,
+            total_timeout=serp_total_timeout,
+            max_retries=serp_max_retries,
+            hedge=serp_hedge,
+            hedge_quantile=serp_hedge_quantile,
+            retry_exceptions=(asyncio.TimeoutError, aiohttp.ClientError, OSError)
+        )
+    return _client('serp_policy', create)
+
+
+def get_model():
+    """
+    Configure Gemini and return the scoring model.
+    """
+    def create():
+        import google.generativeai as genai
 
+        api_key = os.getenv('google_api_key')
+        if gemini_api_endpoint:
+            genai.configure(api_key=api_key, transport='rest', client_options={'api_endpoint': gemini_api_endpoint})
+        else:
+            genai.configure(api_key=api_key)
 
-async def generate_queries(query_templates, keywords):
+        return genai.GenerativeModel("gemini-1.5-flash", generation_config={
+            "temperature": 1.3,
+            "top_p": 0.9,
+            "top_k": 40,
+            "max_output_tokens": 8192,
+            "response_mime_type": "application/json"
+        })
+    return _client('model', create)
+
+
+def get_drive_service():
+    def create():
+        from google_drive.google_drive_client import authenticate_drive
+        return authenticate_drive(service_account_creds, drive_root_url or None)
+    return _client('drive_service', create)
+
+
+def get_drive_index():
     """
-    Generate search queries based on templates and keywords.
+    The local index of the Drive parent folder, loaded from its snapshot and refreshed.
     """
-    queries = []
-    for template in query_templates:
-        query = template
-        for key, value in keywords.items():
-            query = query.replace(f'[{key}]', value)
-        queries.append(query)
-    return queries
+    def create():
+        from google_drive.namespace_index import DriveNamespaceIndex
+        parent_folder_id = os.getenv('google_drive_parent_folder_id')
+        return DriveNamespaceIndex(get_drive_service(), parent_folder_id, drive_index_path).load()
+    return _client('drive_index', create)
 
 
-# async def generate_queries(keywords):
-#     """
-#     Generate search queries based on keywords.
-#     """
-#     queries = []
-#     for query in master_queries:
-#         result = query.replace('[nombre_común]', keywords['common_name'])
-#         result = result.replace('[especies_afectadas]', keywords['affected_species'])
-#         result = result.replace('[Subtipo]', keywords['sub_type'])
-#         result = result.replace('[Nombre Científico]', keywords['scientific_name'])
-#         result = result.replace('[parte_afectada]', keywords['affected_part'])
-#         result = result.replace('[Daño]', keywords['damage'])
+def get_uploader():
+    def create():
+        from google_drive.uploader import DriveUploader
+        return DriveUploader(
+            service_account_creds, max_workers=upload_workers, index=get_drive_index(),
+            root_url=drive_root_url or None
+        )
+    return _client('uploader', create)
 
-#         result = ' '.join(result.split())
-#         queries.append(result)
 
-#     return queries
+def build_search_url(query, params=search_params):
+    """
+    Build the Google Images search URL for a query.
+    """
+    extra = '&'.join(f'{key}={value}' for key, value in params.items())
+    return f'{serp_search_url}?q={quote(query)}&{extra}'
 
 
-async def fetch_query_data(session, query, proxy):
+async def fetch_serp_page(session, url, proxy):
+    """
+    One SERP request through the shared SERP rate limiter, parsed as it streams in.
+    Returns (images, pagination).
     """
-    Get data from the URL with retries for resiliency.
+    async with get_limiter('serp').async_slot() as permit:
+        async with session.get(url, proxy=proxy, ssl=False) as response:
+            permit.status = response.status
+            permit.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if response.status != 200:
+                raise RequestFailed(response.status, permit.retry_after)
+            extractor = ImagesExtractor()
+            async for chunk in response.content.iter_chunked(serp_chunk_size):
+                extractor.feed(chunk)
+            return extractor.images, extractor.pagination
+
+
+async def fetch_result_page(session, query, proxy, start):
     """
-    url = f'https://www.google.es/search?q={quote(query)}&gl=es&tbm=isch&num=100&location=Spain&uule=w+CAIQICIFU3BhaW4&brd_json=1'
+    Fetch the result page of a query that begins at `start`.
+    Returns (images, pagination), or None if it failed.
+    """
+    url = build_search_url(query, dict(search_params, start=start))
+    try:
+        page = await get_serp_policy().run(fetch_serp_page, session, url, proxy)
+    except Exception as e:
+        logging.error(f"Error fetching data from {url}: {e!r}")
+        SERP_PAGES.inc(result='failed')
+        return None
+    SERP_PAGES.inc(result='fetched')
+    return page
+
+
+async def fetch_more_pages(session, query, proxy, images, pagination):
+    """
+    Follow the SERP pagination of a query up to `serp_max_pages` pages and add the
+    image records not seen on earlier pages, stopping at a page with nothing new.
+    """
+    images = list(images)
+    seen = {image.image for image in images}
+    fetched = set()
+    pending = set(page_starts(pagination, serp_max_pages))
+    while pending:
+        starts = sorted(pending)[:serp_page_concurrency]
+        fetched.update(starts)
+        pages = await asyncio.gather(*[fetch_result_page(session, query, proxy, start) for start in starts])
+
+        exhausted = False
+        for start, page in zip(starts, pages):
+            if page is None:
+                continue
+            page_images, page_pagination = page
+            unseen = [image for image in page_images if image.image not in seen]
+            seen.update(image.image for image in unseen)
+            images.extend(unseen)
+            exhausted = exhausted or not unseen
+            pending.update(page_starts(page_pagination, serp_max_pages))
+        pending -= fetched
+        if exhausted:
+            logging.info(f"No unseen images past result {max(starts)} for {query}, not fetching further pages")
+            break
+    return images
+
+
+async def fetch_query_data(session, query, proxy, cache=None):
+    """
+    Get data from the URL with retries for resiliency, or from the SERP cache.
+    Returns the SerpImage records, or None when they could not be fetched.
+    """
+    if cache is not None:
+        cached = cache.get(query, serp_result_params)
+        if cached is not None:
+            logging.info(f"Using cached data for {query}")
+            SERP_QUERIES.inc(result='cache_hit')
+            return images_from_json(cached)
+
+    url = build_search_url(query)
     try:
         logging.info(f"Fetching data for {query}")
-        async with session.get(url, proxy=proxy, ssl=False) as response:
-            if response.status == 200:
-                return await response.json()
-            else:
-                return None
+        if session is None:
+            logging.warning(f"No cached SERP results for {query}")
+            return None
+        with SERP_LATENCY.time():
+            images, pagination = await get_serp_policy().run(fetch_serp_page, session, url, proxy)
+            if serp_max_pages > 1:
+                images = await fetch_more_pages(session, query, proxy, images, pagination)
     except Exception as e:
-        logging.error(f"Error fetching data from {url}: {e}")
+        logging.error(f"Error fetching data from {url}: {e!r}")
+        SERP_QUERIES.inc(result='failed')
         return None
+    SERP_QUERIES.inc(result='fetched')
+
+    if cache is not None:
+        cache.put(query, serp_result_params, images_to_json(images))
+    return images
+
+
+def create_session():
+    """
+    Create the shared aiohttp session used for SERP queries and image downloads.
+    """
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(
+        limit=connection_limit,
+        limit_per_host=connection_limit_per_host,
+        ttl_dns_cache=dns_cache_ttl,
+        keepalive_timeout=keepalive_timeout
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+# query -> task for SERP fetches in progress, shared by rows that ask for the same query
+_serp_in_flight = {}
+
+
+async def fetch_query_data_once(session, query, proxy, cache=None):
+    """
+    fetch_query_data, with concurrent requests for the same query sharing one fetch.
+    Later requests are answered by the SERP cache.
+    """
+    task = _serp_in_flight.get(query)
+    if task is None:
+        task = asyncio.ensure_future(fetch_query_data(session, query, proxy, cache))
+        _serp_in_flight[query] = task
+        task.add_done_callback(lambda _: _serp_in_flight.pop(query, None))
+    return await asyncio.shield(task)
 
 
-async def get_search_results(queries, proxy):
+async def get_search_results(session, queries, proxy, cache=None, on_failed=None):
     """
     Retrieve SERP results for all queries
+    Returns {query: list of SerpImage records} for the queries that returned results.
+    `on_failed(query)` is called for every query whose results could not be fetched.
     """
-    async with aiohttp.ClientSession() as session:
-        tasks = [fetch_query_data(session, query, proxy) for query in queries]
-        results = await asyncio.gather(*tasks)
-        return [result for result in results if result]
+    tasks = [fetch_query_data_once(session, query, proxy, cache) for query in queries]
+    results = await asyncio.gather(*tasks)
+    if on_failed is not None:
+        for query, result in zip(queries, results):
+            if result is None:
+                on_failed(query)
+    return {query: result for query, result in zip(queries, results) if result}
 
 
-async def get_unique_image_urls(results: list) -> set:
+async def get_unique_image_urls(results: dict) -> dict:
     """
-    Extract unique image URLs from SERP results.
+    Extract unique image URLs from SERP results, each with the first query and
+    SerpImage record it was found under. URLs with the same canonical form (see
+    url_index.canonicalize_url) count once, under the first URL found.
     """
-    image_urls = {image['image'] for query_result in results for image in query_result.get('images', [])}
+    image_urls = {}
+    canonical_urls = set()
+    for query, query_result in results.items():
+        for image in query_result:
+            canonical_url = canonicalize_url(image.image)
+            if canonical_url not in canonical_urls:
+                canonical_urls.add(canonical_url)
+                image_urls[image.image] = (query, image)
 
     return image_urls
 
 
-def save_image(image_url, file_path):
+async def fetch_image(session, image_url):
     """
-    Save image to file from a URL or base64 encoded data.
+    Return the bytes of an image from a URL or base64 encoded data.
     """
-    try:
-        if image_url.startswith("data:image"):
-            image_data = base64.b64decode(image_url.split(',')[1])
-            with open(file_path, 'wb') as img_file:
-                img_file.write(image_data)
-        else:
-            response = requests.get(image_url, stream=True)
-            response.raise_for_status()
-            with open(file_path, 'wb') as img_file:
-                img_file.write(response.content)
+    if image_url.startswith("data:image"):
+        return base64.b64decode(image_url.split(',')[1])
+
+    import aiohttp
+
+    timeout = aiohttp.ClientTimeout(total=download_timeout)
+    async with session.get(image_url, timeout=timeout) as response:
+        response.raise_for_status()
+        return await response.read()
 
-        logging.info(f"Image saved at: {file_path}")
+
+def is_transient_download_error(error):
+    """
+    True for download errors a later attempt may not hit: timeouts, connection
+    errors and 408/429/5xx responses. Missing images and bad data are not retried.
+    """
+    import aiohttp
+
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return isinstance(error, (asyncio.TimeoutError, OSError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+
+async def save_image(session, store, image_url, digest=None, on_new=None, reuse=None):
+    """
+    Download an image into memory and register it (deferred) in the content-addressed store.
+    Returns (image_url, digest, image_data), or None for duplicates and unfetchable images.
+    """
+    try:
+        with DOWNLOAD_LATENCY.time():
+            image_data = await fetch_image(session, image_url)
+        IMAGE_BYTES.inc(len(image_data))
+
+        if digest is None:
+            digest, is_new = store.register(image_data, defer=True)
+            if not is_new and (reuse is None or not reuse(digest)):
+                logging.info(f"Duplicate image skipped: {digest}")
+                IMAGES_DOWNLOADED.inc(result='duplicate')
+                return None
+            if on_new is not None:
+                on_new(image_url, digest)
+            if not is_new:
+                logging.info(f"Duplicate image with a cached verdict: {digest}")
+                IMAGES_DOWNLOADED.inc(result='cached')
+                return image_url, digest, image_data
+        elif store.digest(image_data) != digest:
+            logging.warning(f"Image changed since it was journaled: {image_url[:100]}")
+            IMAGES_DOWNLOADED.inc(result='failed')
+            return None
+
+        logging.info(f"Image downloaded: {digest} ({len(image_data)} bytes)")
+        IMAGES_DOWNLOADED.inc(result='new')
+        return image_url, digest, image_data
     except Exception as e:
-        logging.error(f"Error saving image from {image_url}: {e}")
-        print(f"Error saving image from {image_url}: {e}")
+        logging.error(f"Error saving image from {image_url[:100]}: {e}")
+        IMAGES_DOWNLOADED.inc(result='failed')
+        print(f"Error saving image from {image_url[:100]}: {e}")
+        if is_transient_download_error(e):
+            raise
+        return None
+
+
+async def download_images(session, store, image_urls, concurrency=download_concurrency, semaphore=None, digests=None,
+                          on_new=None, reuse=None, on_failed=None):
+    """
+    Download images concurrently, at most `concurrency` at a time or bounded by a shared `semaphore`.
+    Returns (image_url, digest, image_data) for the images that were not already stored.
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(concurrency)
+    if digests is None:
+        digests = [None] * len(image_urls)
+
+    async def bounded_save(image_url, digest):
+        async with semaphore:
+            try:
+                return await save_image(session, store, image_url, digest, on_new, reuse)
+            except Exception:
+                if on_failed is not None:
+                    on_failed(image_url)
+                return None
+
+    saved = await asyncio.gather(*[bounded_save(image_url, digest) for image_url, digest in zip(image_urls, digests)])
+
+    return [result for result in saved if result]
+
+
+def image_part(image_data):
+    """
+    Build the Gemini content part for image bytes.
+    Small images are sent inline; larger ones go through the File API.
+    """
+    mime_type = sniff_image_type(image_data)[0]
+    if len(image_data) <= inline_image_limit:
+        return {'mime_type': mime_type, 'data': image_data}
+    import google.generativeai as genai
+
+    return genai.upload_file(io.BytesIO(image_data), mime_type=mime_type)
 
 
-async def check_image_relevance(model, prompt, image_path):
+def is_relevant(score, verdict):
+    """
+    Apply the relevance threshold to a Gemini score and verdict.
+    """
+    return score > relevance_threshold and verdict == "Y"
+
+
+# output format appended to a row's prompt when a single image is scored
+SINGLE_VERDICT_FORMAT = """Return the response strictly in json format:
+                    {
+                    "score_1_to_10":"numberscore_out_of_10_here",
+                    "Final_Verdict":"Y/N"
+                    }"""
+
+
+def check_image_relevance(model, prompt, image_data, digest=None, cache=None):
     """
     Check relevancy of an image based on keywords using Gemini.
+    Returns (score, verdict), or None when the image could not be scored.
     """
-    try:
-        myfile = genai.upload_file(image_path)
-        # print(f"{myfile=}")
+    if cache is not None and digest is not None:
+        cached = cache.get(digest, prompt)
+        if cached is not None:
+            logging.info(f"Cached verdict for {digest}: {cached}")
+            return cached
 
-        result = model.generate_content([myfile, prompt])
+    try:
+        with RELEVANCE_LATENCY.time(mode='single'):
+            result = get_limiter('gemini').call(
+                model.generate_content, [image_part(image_data), f"{prompt}\n{SINGLE_VERDICT_FORMAT}"]
+            )
         # print(f"{result.text=}")
         response_json = json.loads(result.text)
 
-        return int(response_json.get("score_1_to_10", 0)) > 7 and response_json.get("Final_Verdict") == "Y"
+        score = int(response_json.get("score_1_to_10", 0))
+        verdict = response_json.get("Final_Verdict")
+        if cache is not None and digest is not None:
+            cache.put(digest, prompt, score, verdict)
+
+        return score, verdict
     except Exception as e:
-        logging.error(f"Error checking image relevance for {image_path}: {e}")
-        print(f"Error checking image relevance for {image_path}: {e}")
+        logging.error(f"Error checking image relevance for {digest}: {e}")
+        print(f"Error checking image relevance for {digest}: {e}")
+        return None
 
 
-async def extract_pagas_excel_data(df, proxy, model, drive, parent_id):
+def parse_batch_verdicts(response_text, count):
     """
-    Extract data from Excel, perform search, and save images.
+    Parse a batched Gemini response into {image_number: (score, verdict)}.
+    Entries that are missing or malformed are left out.
+    """
+    try:
+        response_json = json.loads(response_text)
+    except ValueError:
+        return {}
+    if isinstance(response_json, dict):
+        response_json = response_json.get("images", [])
+    if not isinstance(response_json, list):
+        return {}
+
+    verdicts = {}
+    for entry in response_json:
+        try:
+            number = int(entry["image"])
+            score = int(entry["score_1_to_10"])
+            verdict = entry["Final_Verdict"]
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 1 <= number <= count and verdict in ("Y", "N"):
+            verdicts[number] = (score, verdict)
+    return verdicts
+
+
+def check_images_relevance_batch(model, prompt, images, cache=None):
+    """
+    Check relevancy of several (digest, image_data) with a single Gemini request.
+    Returns (score, verdict) or None for each image, in order.
+    """
+    results = [None] * len(images)
+    pending = []
+    for position, (digest, image_data) in enumerate(images):
+        cached = cache.get(digest, prompt) if cache is not None else None
+        if cached is not None:
+            results[position] = cached
+        else:
+            pending.append(position)
+
+    if len(pending) > 1:
+        contents = []
+        uploaded = []
+        for position in pending:
+            digest, image_data = images[position]
+            try:
+                part = image_part(image_data)
+            except Exception as e:
+                logging.error(f"Error uploading {digest} to Gemini: {e}")
+                continue
+            uploaded.append(position)
+            contents.extend([f"Image {len(uploaded)}:", part])
+
+        batch_prompt = f"""You are given {len(uploaded)} images, labelled "Image 1" to "Image {len(uploaded)}".
+                    Answer the following for each image independently:
+                    {prompt}
+                    Return the response strictly as a json array with one object per image:
+                    [
+                    {{"image": 1, "score_1_to_10": "numberscore_out_of_10_here", "Final_Verdict": "Y/N"}}
+                    ]"""
+
+        verdicts = {}
+        if uploaded:
+            try:
+                with RELEVANCE_LATENCY.time(mode='batch'):
+                    result = get_limiter('gemini').call(model.generate_content, contents + [batch_prompt])
+                verdicts = parse_batch_verdicts(result.text, len(uploaded))
+            except Exception as e:
+                logging.error(f"Error checking batched image relevance: {e}")
+
+        for number, position in enumerate(uploaded, start=1):
+            if number in verdicts:
+                score, verdict = verdicts[number]
+                if cache is not None:
+                    cache.put(images[position][0], prompt, score, verdict)
+                results[position] = score, verdict
+
+        if len(verdicts) < len(pending):
+            logging.info(f"Batched verdicts for {len(verdicts)}/{len(pending)} images, scoring the rest individually")
+
+    for position in pending:
+        if results[position] is None:
+            digest, image_data = images[position]
+            results[position] = check_image_relevance(model, prompt, image_data, digest, cache)
+
+    return results
+
+
+# stages a run can be limited to; normalizing is part of scoring
+PIPELINE_STAGES = ('search', 'download', 'score', 'upload')
+
+
+async def _as_async_iterator(rows):
+    for row in rows:
+        yield row
+
+
+class RunContext:
+    """
+    Shared clients, caches and the run journal for one run.
+    Clients the run's stages do not need are None.
     """
 
-    data_set = {}
-    data = []
-    for _, row in df.iloc[:5].iterrows():
+    def __init__(self, session, proxy, model, drive_index, uploader, serp_cache, store, verdict_cache, journal, results=None,
+                 seen_urls=None):
+        self.session = session
+        self.proxy = proxy
+        self.model = model
+        self.drive_index = drive_index
+        self.uploader = uploader
+        self.serp_cache = serp_cache
+        self.store = store
+        self.verdict_cache = verdict_cache
+        self.journal = journal
+        self.results = results
+        self.seen_urls = seen_urls
+
+
+class RowTask:
+    """
+    One Excel row moving through the pipeline.
+    The row is finished when `pending`, its work items still in flight, drops back to zero.
+    """
 
-        keywords = await extract_keywords_plagas(row)
-        queries = await generate_queries(master_queries_for_plagas, keywords)
-        search_result = await get_search_results(queries, proxy)
+    def __init__(self, sheet, row_index, queries, prompt, folder_name, label=None, labels=None):
+        self.sheet = sheet
+        self.row_index = int(row_index)
+        self.queries = queries
+        self.prompt = prompt
+        self.folder_name = folder_name
+        self.label = label
+        # training labels of the row, exported with its accepted images
+        self.labels = labels or {}
+        self.search_result = None
+        self.sources = {}
+        self.image_count = 0
+        self.image_folder_path = None
+        self.drive_folder_id = None
+        self.errors = 0
+        self.pending = 0
+
+    @property
+    def task_id(self):
+        return f'{self.sheet}|{self.row_index}'
+
+    def to_payload(self):
+        """
+        The fields a worker process needs to rebuild the row from the work queue.
+        """
+        return {
+            'sheet': self.sheet,
+            'row_index': self.row_index,
+            'queries': self.queries,
+            'prompt': self.prompt,
+            'folder_name': self.folder_name,
+            'label': self.label,
+            'labels': self.labels
+        }
+
+    @classmethod
+    def from_payload(cls, payload):
+        return cls(**payload)
+
+
+class Pipeline:
+    """
+    Search -> download -> normalize -> score -> upload pipeline over asyncio stages
+    connected by bounded queues, limited to `stages` and journaled so a rerun resumes.
+    """
 
-        unique_image_urls = await get_unique_image_urls(search_result)
-        image_folder_path = await get_or_create_folder(row["Tipo"])
-        drive_image_folder_id = get_or_create_gd_folder(drive, row["Tipo"], parent_id=parent_id)
+    def __init__(self, ctx, on_row_finished=None, stages=PIPELINE_STAGES):
+        self.ctx = ctx
+        self.on_row_finished = on_row_finished
+        self.stages = frozenset(stages)
+        self.search_queue = asyncio.Queue(maxsize=pipeline_queue_size)
+        self.download_queue = asyncio.Queue(maxsize=pipeline_queue_size)
+        self.normalize_queue = asyncio.Queue(maxsize=pipeline_queue_size)
+        self.score_queue = asyncio.Queue(maxsize=pipeline_queue_size)
+        self.upload_queue = asyncio.Queue(maxsize=pipeline_queue_size)
+        self.rows_in_flight = asyncio.Semaphore(max_rows_in_flight)
+        self.download_semaphore = asyncio.Semaphore(download_concurrency)
+        # the parent runs Gemini, Drive and metrics threads, so the image processes are not forked from it
+        self.image_executor = ProcessPoolExecutor(
+            max_workers=max(1, normalize_processes // _local_processes),
+            mp_context=multiprocessing.get_context(
+                'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            )
+        )
+        self.gemini_executor = ThreadPoolExecutor(max_workers=score_workers, thread_name_prefix='gemini')
+        # folder creation shares the single Drive client, uploads go through ctx.uploader
+        self.drive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='drive')
+        self.folder_lock = asyncio.Lock()
+
+    async def run(self, rows):
+        """
+        Push rows through every stage and wait until all of them are finished.
+        `rows` may be a list or an async iterator; the next row is only taken
+        once there is room for it. Returns the number of rows processed.
+        """
+        stages = [
+            ('search', self.search_queue, self.search_stage, search_workers),
+            ('download', self.download_queue, self.download_stage, download_workers),
+            ('normalize', self.normalize_queue, self.normalize_stage, normalize_workers),
+            ('score', self.score_queue, self.score_stage, score_workers),
+            ('upload', self.upload_queue, self.upload_stage, upload_workers),
+        ]
+        workers = [
+            asyncio.create_task(self._worker(name, queue, handler))
+            for name, queue, handler, count in stages
+            for _ in range(count)
+        ]
+        fed = 0
+        row_iterator = rows.__aiter__() if hasattr(rows, '__aiter__') else _as_async_iterator(rows)
+        try:
+            while True:
+                await self.rows_in_flight.acquire()
+                try:
+                    row = await row_iterator.__anext__()
+                except StopAsyncIteration:
+                    self.rows_in_flight.release()
+                    break
+                fed += 1
+                ROWS_IN_FLIGHT.inc()
+                await self.search_queue.put(row)
+
+            # Upstream stages only emit work while they are busy, so joining the
+            # queues in pipeline order waits for everything to drain.
+            for _, queue, _, _ in stages:
+                await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.image_executor.shutdown(wait=False)
+            self.gemini_executor.shutdown(wait=False)
+            self.drive_executor.shutdown(wait=False)
+
+        return fed
+
+    async def _worker(self, name, queue, handler):
+        while True:
+            item = await queue.get()
+            try:
+                with IN_FLIGHT.track(stage=name):
+                    await handler(item)
+            except Exception as e:
+                logging.error(f"Error in {name} stage: {e}")
+            finally:
+                queue.task_done()
+
+    async def _offload(self, executor, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, func, *args)
+
+    async def _emit(self, queue, row, item):
+        row.pending += 1
+        await queue.put((row, item))
+
+    def _release(self, row):
+        row.pending -= 1
+        if row.pending == 0:
+            self._finish_row(row)
+
+    def _result(self, row, image_url, digest, verdict, score=None, drive_id=None, reason=None):
+        """
+        Add the outcome for one of the row's images to the results log.
+        """
+        if self.ctx.results is None:
+            return
+        query, image = row.sources.get(image_url, (None, None))
+        self.ctx.results.add(
+            row.sheet, row.row_index, image_url, digest, verdict, query=query,
+            source=image.source if image else None, link=image.link if image else None,
+            score=score, drive_id=drive_id, reason=reason
+        )
+
+    def _finish_row(self, row):
+        complete = self.stages.issuperset(PIPELINE_STAGES)
+        if complete and not row.errors and self.ctx.journal.stage(row.sheet, row.row_index) != 'done':
+            self.ctx.journal.record(row.sheet, row.row_index, 'done')
+        self.ctx.journal.flush()
+        if self.ctx.results is not None:
+            self.ctx.results.flush()
+        row.sources = {}
+        logging.info(f"Finished row {row.sheet}:{row.row_index} with {row.errors} errors")
+        ROWS_FINISHED.inc(result='errors' if row.errors else 'ok')
+        ROWS_IN_FLIGHT.dec()
+        if self.on_row_finished is not None:
+            try:
+                self.on_row_finished(row)
+            except Exception as e:
+                logging.error(f"Error reporting row {row.sheet}:{row.row_index}: {e}")
+        self.rows_in_flight.release()
+
+    async def search_stage(self, row):
+        """
+        Fetch SERP results for a row, or read them from the cache when searching is off.
+        """
+        ctx = self.ctx
+        try:
+            if ctx.journal.stage(row.sheet, row.row_index) == 'done':
+                logging.info(f"Skipping completed row {row.sheet}:{row.row_index}")
+                self._finish_row(row)
+                return
+
+            # without the search stage the session is only for downloads, results come from the cache
+            session = ctx.session if 'search' in self.stages else None
+            failed = []
+            row.search_result = await get_search_results(
+                session, row.queries, ctx.proxy, ctx.serp_cache, on_failed=failed.append
+            )
+            # the row is searched again by a later run
+            row.errors += len(failed)
+            if 'search' in self.stages and not failed:
+                ctx.journal.record(row.sheet, row.row_index, 'searched')
+        except Exception:
+            row.errors += 1
+            self._finish_row(row)
+            raise
+
+        if self.stages == {'search'}:
+            self._finish_row(row)
+            return
+
+        # Held by the download stage until it has emitted all of the row's work.
+        row.pending = 1
+        await self.download_queue.put(row)
+
+    async def download_stage(self, row):
+        """
+        Download the row's new images and hand them to the normalize stage in batches.
+        Images the journal already has further along skip straight to their next stage,
+        and images another row of the run saw first are not fetched again.
+        """
+        ctx = self.ctx
+        journal = ctx.journal
+        stages = self.stages
+        try:
+            row.sources = await get_unique_image_urls(row.search_result)
+            row.image_count = len(row.sources)
+            row.search_result = None
+
+            seen_elsewhere = {}
+            if ctx.seen_urls is not None:
+                canonical_urls = {image_url: canonicalize_url(image_url) for image_url in row.sources}
+                seen_elsewhere = ctx.seen_urls.claim(row.sheet, row.row_index, canonical_urls.values())
+
+            to_download, digests, to_score = [], [], []
+            for image_url in row.sources:
+                record = journal.get(row.sheet, row.row_index, image_key(image_url))
+                if record is None:
+                    if seen_elsewhere and canonical_urls[image_url] in seen_elsewhere:
+                        URLS_SKIPPED.inc()
+                        continue
+                    if 'download' in stages:
+                        to_download.append(image_url)
+                        digests.append(None)
+                elif record['stage'] == 'downloaded':
+                    if 'score' not in stages:
+                        continue
+                    # kept by a download-only run, otherwise the bytes only lived in memory
+                    image_data = ctx.store.read(record['digest'])
+                    if image_data is not None:
+                        to_score.append((image_url, record['digest'], image_data))
+                    elif 'download' in stages:
+                        to_download.append(image_url)
+                        digests.append(record['digest'])
+                elif record['stage'] == 'scored' and record['relevant'] and 'upload' in stages:
+                    await self._emit(self.upload_queue, row, (image_url, record['digest']))
+
+            def journal_download(image_url, digest):
+                journal.record(row.sheet, row.row_index, 'downloaded', image_key(image_url), digest=digest)
+
+            def has_cached_verdict(digest):
+                # identical bytes seen for the same prompt are scored from the verdict cache
+                return ctx.verdict_cache.get(digest, row.prompt) is not None
+
+            failed = []
+            downloaded = await download_images(
+                ctx.session, ctx.store, to_download, semaphore=self.download_semaphore, digests=digests,
+                on_new=journal_download,
+                reuse=has_cached_verdict if 'score' in stages and ctx.verdict_cache is not None else None,
+                on_failed=failed.append
+            )
+            # images that failed to download were not journaled, so a later run fetches them again
+            row.errors += len(failed)
+            # new digests are only indexed once their journal records are on disk
+            journal.flush()
+            ctx.store.flush()
+            if 'score' not in stages:
+                for _, digest, image_data in downloaded:
+                    ctx.store.write(digest, image_data)
+
+            if 'score' in stages:
+                to_score += downloaded
+
+            for start in range(0, len(to_score), relevance_batch_size):
+                await self._emit(self.normalize_queue, row, to_score[start:start + relevance_batch_size])
+        except Exception:
+            row.errors += 1
+            raise
+        finally:
+            self._release(row)
+
+    async def normalize_stage(self, item):
+        """
+        Pre-filter, decode and downscale a batch of images for scoring on the process pool.
+        Images the pre-filter rejects (undecodable, tiny, blank, ...) never reach Gemini.
+        """
+        row, batch = item
+        ctx = self.ctx
+        try:
+            screened = await asyncio.gather(*[
+                self._offload(self.image_executor, screen_image, image_data, prefilter_config, scoring_max_edge, scoring_quality)
+                for _, _, image_data in batch
+            ], return_exceptions=True)
+
+            to_score = []
+            for (image_url, digest, image_data), outcome in zip(batch, screened):
+                if isinstance(outcome, Exception):
+                    logging.error(f"Pre-filter failed for {digest}: {outcome!r}")
+                    outcome = None, 'prefilter_error'
+                scoring_data, reason = outcome
+                if reason is not None:
+                    logging.info(f"Image rejected by the pre-filter ({reason}): {digest}")
+                    ctx.store.discard(digest)
+                    VERDICTS.inc(verdict='prefiltered')
+                    PREFILTER_REJECTIONS.inc(reason=reason)
+                    self._result(row, image_url, digest, 'prefiltered', reason=reason)
+                    ctx.journal.record(
+                        row.sheet, row.row_index, 'scored', image_key(image_url), digest=digest, relevant=False, reason=reason
+                    )
+                else:
+                    to_score.append((image_url, digest, image_data, scoring_data))
+
+            if to_score:
+                await self._emit(self.score_queue, row, to_score)
+        except Exception:
+            row.errors += 1
+            raise
+        finally:
+            self._release(row)
+
+    async def score_stage(self, item):
+        """
+        Score a batch of downscaled images with Gemini and store and queue the relevant ones for upload.
+        """
+        row, batch = item
+        ctx = self.ctx
+        try:
+            verdicts = await self._offload(
+                self.gemini_executor, check_images_relevance_batch,
+                ctx.model, row.prompt, [(digest, scoring_data) for _, digest, _, scoring_data in batch], ctx.verdict_cache
+            )
+
+            for (image_url, digest, image_data, _), scored in zip(batch, verdicts):
+                if scored is None:
+                    logging.warning(f"Image left for a later run, Gemini could not score it: {digest}")
+                    VERDICTS.inc(verdict='unscored')
+                    row.errors += 1
+                    continue
+                score = scored[0]
+                relevant = is_relevant(*scored)
+                VERDICTS.inc(verdict='accepted' if relevant else 'rejected')
+                if relevant:
+                    image_file_path = ctx.store.write(digest, image_data)
+                    logging.info(f"Image saved at: {image_file_path}")
+                ctx.journal.record(
+                    row.sheet, row.row_index, 'scored', image_key(image_url), digest=digest, relevant=relevant, score=score
+                )
+                if relevant:
+                    if 'upload' in self.stages:
+                        await self._emit(self.upload_queue, row, (image_url, digest))
+                    else:
+                        self._result(row, image_url, digest, 'accepted', score=score)
+                else:
+                    self._result(row, image_url, digest, 'rejected', score=score)
+                    ctx.store.discard(digest)
+                    logging.info(f"Irrelevant image skipped: {digest}")
+                    print(f"Irrelevant image skipped: {digest}")
+        except Exception:
+            row.errors += 1
+            raise
+        finally:
+            self._release(row)
+
+    async def _resolve_folders(self, row):
+        """
+        Create the row's local label folder and Drive folder on its first upload.
+        """
+        async with self.folder_lock:
+            if row.drive_folder_id is None:
+                row.image_folder_path = await get_or_create_folder(row.folder_name)
+                row.drive_folder_id = await self._offload(
+                    self.drive_executor, self.ctx.drive_index.get_or_create_folder, row.folder_name
+                )
 
-        for count, image_url in enumerate(unique_image_urls):
+    async def upload_stage(self, item):
+        """
+        Upload an accepted image to the row's Drive folder.
+        """
+        row, (image_url, digest) = item
+        ctx = self.ctx
+        try:
+            await self._resolve_folders(row)
+            labelled_file_path = ctx.store.link(digest, row.image_folder_path)
+            file_id = await asyncio.wrap_future(ctx.uploader.submit(labelled_file_path, row.drive_folder_id))
+            scored = ctx.journal.get(row.sheet, row.row_index, image_key(image_url)) or {}
+            self._result(row, image_url, digest, 'accepted', score=scored.get('score'), drive_id=file_id)
+            if file_id:
+                ctx.journal.record(row.sheet, row.row_index, 'uploaded', image_key(image_url), digest=digest, file_id=file_id)
+            else:
+                row.errors += 1
+        except Exception:
+            row.errors += 1
+            raise
+        finally:
+            self._release(row)
 
-            image_file_path = os.path.join(
-                image_folder_path,
-                f'{row["Nombre Científico"]}_image_{count}.jpg'
-                )
 
-            save_image(image_url, image_file_path)
+def plan_pagas_rows(df):
+    """
+    Build the pipeline row for every row of the 'Plagas' sheet.
+    """
+    keyword_table = extract_keywords_plagas(df)
+    all_queries = plagas_query_templates.expand_table(keyword_table)
+
+    rows = []
+    for row_index, keywords, queries in zip(keyword_table.index, keyword_table.to_dict('records'), all_queries):
 
-            prompt = f"""Please tell me whether the image given is of this or not check thourghly ,
+        prompt = f"""Please tell me whether the image given is of this or not check thourghly ,
                     common name: {keywords['nombre_común']}
                     scientific name: {keywords['Nombre Científico']}
-                    Based on your assessment give relevancy score on the scale of 1 to 10."
-                    Return the response strictly in json format:
-                    {{
-                    "score_1_to_10":"numberscore_out_of_10_here",
-                    "Final_Verdict":"Y/N"
-                    }}"""
-
-            if await check_image_relevance(model, prompt, image_file_path):
-                upload_file(drive, image_file_path, drive_image_folder_id)
-            else:
-                logging.info(f"Irrelevant image removed: {image_file_path}")
-                print(f"Irrelevant image removed: {image_file_path}")
+                    Based on your assessment give relevancy score on the scale of 1 to 10."""
 
-        data_set[row["Nombre Científico"]] = search_result
-        data.append(data_set)
+        labels = {name: keywords[name] for name in ('Tipo', 'Subtipo', 'Nombre Científico')}
+        rows.append(RowTask('Plagas', row_index, queries, prompt, keywords["Tipo"], label=keywords["Nombre Científico"], labels=labels))
 
-    return data
+    return rows
 
 
-async def extract_defici_excel_data(df, proxy, model, drive, parent_id):
+def plan_defici_rows(df):
     """
-    Extract data from Excel, perform search, and save images for deficiency.
+    Build the pipeline row for every characteristic row of the 'Deficiencias' sheet.
     """
-    current_disorder = None
-
-    for _, row in df.iterrows():
+    keyword_table = extract_keywords_defici(df)
+    all_queries = defici_query_templates.expand_table(keyword_table)
 
-        if pd.isna(row["Característica"]):
-            current_disorder = row["disorders"]
-        else:
-            keywords = {
-                'characteristic': row["Característica"],
-                'affected_part': row["Parte Afectada"]
-            }
-            queries = await generate_queries(master_queries_for_Deficiencias, keywords)
-            search_result = await get_search_results(queries, proxy)
-
-            unique_image_urls = await get_unique_image_urls(search_result)
-            image_folder_path = await get_or_create_folder(current_disorder)
-            drive_image_folder_id = get_or_create_gd_folder(drive, current_disorder, parent_id=parent_id)
-
-            for count, image_url in enumerate(unique_image_urls):
-
-                image_file_path = os.path.join(
-                    image_folder_path,
-                    f'{current_disorder}_image_{count}.jpg'
-                    )
-                save_image(image_url, image_file_path)
+    rows = []
+    for row_index, keywords, queries in zip(keyword_table.index, keyword_table.to_dict('records'), all_queries):
 
-                prompt = f"""Please tell me whether the image given is of this or not check thourghly ,
+        prompt = f"""Please tell me whether the image given is of this or not check thourghly ,
                     characteristics: {keywords['characteristic']}
-                    disorder: {current_disorder}
-                    Based on your assessment give relevancy score on the scale of 1 to 10."
-                    Return the response strictly in json format:
-                    {{
-                    "score_1_to_10":"numberscore_out_of_10_here",
-                    "Final_Verdict":"Y/N"
-                    }}"""
+                    disorder: {keywords['disorder']}
+                    Based on your assessment give relevancy score on the scale of 1 to 10."""
+
+        labels = {'disorder': keywords['disorder']}
+        rows.append(RowTask('Deficiencias', row_index, queries, prompt, keywords['disorder'], label=keywords['disorder'], labels=labels))
+
+    return rows
 
-                if await check_image_relevance(model, prompt, image_file_path):
-                    upload_file(drive, image_file_path, drive_image_folder_id)
-                else:
-                    logging.info(f"Irrelevant image removed: {image_file_path}")
-                    print(f"Irrelevant image removed: {image_file_path}")
 
+async def extract_pagas_excel_data(ctx, df, stages=PIPELINE_STAGES):
+    """
+    Extract data from Excel, perform search, and save images.
+    Per-image outcomes are streamed to the run results log.
+    """
+    await Pipeline(ctx, stages=stages).run(plan_pagas_rows(df))
 
-async def main():
-    # load environment variable
-    load_dotenv()
 
+async def extract_defici_excel_data(ctx, df, stages=PIPELINE_STAGES):
+    """
+    Extract data from Excel, perform search, and save images for deficiency.
+    """
+    await Pipeline(ctx, stages=stages).run(plan_defici_rows(df))
+
+
+def get_proxy():
+    """
+    The SERP proxy URL, or None to connect directly when no proxy host is configured.
+    """
     host = os.getenv('host')
     port = os.getenv('port')
     username = os.getenv('proxy_username')
     password = os.getenv('proxy_password')
+    if not host:
+        return None
+
+    return f'http://{username}:{password}@{host}:{port}'
+
+
+@asynccontextmanager
+async def open_run_context(shared=False, stages=PIPELINE_STAGES):
+    """
+    Create the caches, journal and clients `stages` need for a run and close them afterwards.
+    With `shared=True` the process is one of several workers.
+    """
+    stages = frozenset(stages)
+    model = get_model() if 'score' in stages else None
+    drive_index = get_drive_index() if 'upload' in stages else None
+    uploader = get_uploader() if 'upload' in stages else None
+
+    serp_cache = SerpCache(serp_cache_dir, ttl=serp_cache_ttl, max_bytes=serp_cache_max_bytes)
+    store = ImageStore(image_store_dir, shared=shared)
+    verdict_cache = VerdictCache(verdict_cache_path, model.model_name, ttl=verdict_cache_ttl) if model else None
+    journal = RunJournal(run_journal_path, flush_every=journal_flush_every, shared=shared)
+    results = ResultsWriter(run_results_path)
+    seen_urls = SeenUrlIndex(seen_urls_path) if 'download' in stages else None
+
+    try:
+        async with AsyncExitStack() as stack:
+            session = None
+            if stages & {'search', 'download'}:
+                session = await stack.enter_async_context(create_session())
+            yield RunContext(
+                session, get_proxy(), model, drive_index, uploader, serp_cache, store, verdict_cache, journal, results,
+                seen_urls
+            )
+    finally:
+        journal.close()
+        store.flush()
+        results.close()
+        if seen_urls is not None:
+            seen_urls.close()
+        if drive_index is not None and not shared:
+            drive_index.save()
+
+
+def start_metrics_exporter(worker_index=None):
+    """
+    Start publishing this process's metrics as configured. Each worker process
+    has its own metrics, so worker `i` serves them on `metrics_port + 1 + i` and
+    writes `<metrics_file stem>.<i><ext>`.
+    """
+    port, file_path = metrics_port, metrics_file
+    if worker_index is not None:
+        port = metrics_port + 1 + worker_index if metrics_port else 0
+        if file_path:
+            root, ext = os.path.splitext(file_path)
+            file_path = f'{root}.{worker_index}{ext}'
+    return MetricsExporter(port, file_path or None, metrics_interval).start()
+
+
+def stop_metrics_exporter(exporter):
+    """
+    Publish the final metrics and log the run summary.
+    """
+    exporter.stop()
+    logging.info(f"Run metrics:\n{registry.summary()}")
+
+
+def close_clients():
+    """
+    Shut down the process-wide clients once the process is done with them.
+    """
+    with _clients_lock:
+        uploader = _clients.pop('uploader', None)
+        serp_policy = _clients.pop('serp_policy', None)
+    if uploader is not None:
+        uploader.shutdown()
+    if serp_policy is not None:
+        serp_policy.shutdown()
 
-    proxies = {
-        'http': f'http://{username}:{password}@{host}:{port}',
-        'https': f'http://{username}:{password}@{host}:{port}'
-    }
 
-    proxy = f'http://{username}:{password}@{host}:{port}'
+async def main(stages=PIPELINE_STAGES, sheets=('Plagas', 'Deficiencias')):
+    exporter = start_metrics_exporter()
+    try:
+        async with open_run_context(stages=stages) as ctx:
+            if 'Plagas' in sheets:
+                plagas_excel_data = load_excel_data(excel_file, sheet_name='Plagas')
+                await extract_pagas_excel_data(ctx, plagas_excel_data, stages)
 
-    # Gemini setup
-    api_key = os.getenv('google_api_key')
-    genai.configure(api_key=api_key)
+            if 'Deficiencias' in sheets:
+                defici_excel_data = load_excel_data(excel_file, sheet_name='Deficiencias')
+                await extract_defici_excel_data(ctx, defici_excel_data, stages)
+    finally:
+        stop_metrics_exporter(exporter)
 
-    model = genai.GenerativeModel("gemini-1.5-flash", generation_config={
-        "temperature": 1.3,
-        "top_p": 0.9,
-        "top_k": 40,
-        "max_output_tokens": 8192,
-        "response_mime_type": "application/json"
-    })
 
-    # google drive
-    service_account_creds = os.path.join(current_directory, 'service_account.json')
-    drive_service = authenticate_drive(service_account_creds)
-    parent_folder_id = os.getenv('google_drive_parent_folder_id')
+def export_dataset(sheets=('Plagas', 'Deficiencias')):
+    """
+    Append the accepted images that are not exported yet to the training shards
+    in `dataset_dir`, labelled from their spreadsheet rows.
+    """
+    rows = []
+    if 'Plagas' in sheets:
+        rows += plan_pagas_rows(load_excel_data(excel_file, sheet_name='Plagas'))
+    if 'Deficiencias' in sheets:
+        rows += plan_defici_rows(load_excel_data(excel_file, sheet_name='Deficiencias'))
+
+    journal = RunJournal(run_journal_path)
+    writer = ShardWriter(dataset_dir, max_bytes=dataset_shard_bytes, max_samples=dataset_shard_samples)
+    try:
+        added = export_accepted(journal, ImageStore(image_store_dir), {(row.sheet, row.row_index): row.labels for row in rows}, writer)
+    finally:
+        writer.close()
+    logging.info(f"Exported {added} new samples in {writer.shards_written} shards to {dataset_dir}")
+    return added
 
-    excel_file = os.path.join(current_directory,'Indice de Entrenamiento- Citricos (2).xlsx')
 
-    plagas_excel_data = await load_excel_data(excel_file,sheet_name='Plagas')
-    data = await extract_pagas_excel_data(plagas_excel_data, proxy, model, drive_service, parent_folder_id)
+def plan_queue(queue, sheets=('Plagas', 'Deficiencias')):
+    """
+    Queue every spreadsheet row and create the Drive folders the rows upload to,
+    so worker processes never race to create the same folder.
+    """
+    rows = []
+    if 'Plagas' in sheets:
+        rows += plan_pagas_rows(load_excel_data(excel_file, sheet_name='Plagas'))
+    if 'Deficiencias' in sheets:
+        rows += plan_defici_rows(load_excel_data(excel_file, sheet_name='Deficiencias'))
+    total = queue.enqueue((row.task_id, row.to_payload()) for row in rows)
+    logging.info(f"Queued {len(rows)} rows ({total} tasks in {queue.db_path})")
+
+    drive_index = get_drive_index()
+    for folder_name in {row.folder_name for row in rows}:
+        drive_index.get_or_create_folder(folder_name)
+    drive_index.save()
+
+
+async def queue_worker(worker_id):
+    """
+    Claim rows from the work queue and run them through the pipeline until no
+    queued or leased rows are left. Leases are renewed while rows are in flight,
+    finished rows are completed and rows with errors are failed (and retried).
+    """
+    queue = WorkQueue(work_queue_path, lease_seconds=lease_seconds, max_attempts=max_task_attempts)
+    leased = {}
+
+    def on_row_finished(row):
+        if leased.pop(row.task_id, None) is None:
+            return
+        if row.errors:
+            queue.fail(row.task_id, worker_id, f'{row.errors} errors')
+        else:
+            queue.complete(row.task_id, worker_id, {
+                'label': row.label,
+                'images': row.image_count
+            })
+
+    async with open_run_context(shared=True) as ctx:
+
+        async def claimed_rows():
+            while True:
+                claimed = queue.claim(worker_id)
+                if claimed is not None:
+                    task_id, payload = claimed
+                    row = RowTask.from_payload(payload)
+                    leased[task_id] = row
+                    # pick up what other workers journaled for this row
+                    ctx.journal.refresh()
+                    yield row
+                elif queue.pending():
+                    await asyncio.sleep(queue_poll_interval)
+                else:
+                    return
+
+        async def renew_leases():
+            while True:
+                await asyncio.sleep(lease_seconds / 3)
+                queue.extend(list(leased), worker_id)
+
+        renewer = asyncio.create_task(renew_leases())
+        try:
+            await Pipeline(ctx, on_row_finished).run(claimed_rows())
+        finally:
+            renewer.cancel()
+            queue.close()
+
+
+def run_worker(worker_index, process_count):
+    """
+    Entry point of a worker process.
+    """
+    global _local_processes
+
+    # the processes on this machine split the rate limits and image processes between them
+    set_process_share(process_count)
+    _local_processes = process_count
+    worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    logging.info(f"Worker {worker_index} started as {worker_id}")
+    exporter = start_metrics_exporter(worker_index)
+    try:
+        asyncio.run(queue_worker(worker_id))
+    finally:
+        close_clients()
+        stop_metrics_exporter(exporter)
+
+
+def run_queue(process_count, plan=True, sheets=('Plagas', 'Deficiencias')):
+    """
+    Distribute the spreadsheet rows over `process_count` worker processes through
+    the work queue. Additional machines sharing the queue file run with
+    `plan=False` and only add workers.
+    """
+    if plan:
+        queue = WorkQueue(work_queue_path, lease_seconds=lease_seconds, max_attempts=max_task_attempts)
+        plan_queue(queue, sheets)
+        queue.close()
+
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(index, process_count)) for index in range(process_count)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
 
-    defici_excel_data = load_excel_data(excel_file,sheet_name='Deficiencias')
-    await extract_defici_excel_data(defici_excel_data, proxy, model, drive_service, parent_folder_id)
+    queue = WorkQueue(work_queue_path)
+    logging.info(f"Work queue finished: {queue.counts()}")
+    queue.close()
 
-    with open("new_data.json", 'w') as f:
-        json.dump(data, f, indent=4)
+    if plan:
+        RunJournal(run_journal_path).compact()
 
 
 if __name__ == '__main__':
 
-    asyncio.run(main())
+    if worker_processes > 1 or join_queue:
+        run_queue(worker_processes, plan=not join_queue)
+    else:
+        try:
+            asyncio.run(main())
+        finally:
+            close_clients()
@@ -0,0 +1,316 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+import threading
+import logging
+import bisect
+import time
+import os
+
+
+# latency buckets in seconds, from a cache hit to a slow Gemini batch
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """
+    A named metric with a fixed set of label names; one value per label combination.
+    """
+
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        """
+        Return (suffix, label values, extra labels, value) tuples for the text exposition.
+        """
+        with self._lock:
+            return [('', key, '', value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_label_text(self.label_names, key, extra)} {value:g}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        Count the block as in flight while it runs. Works around awaits as well.
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """
+    Cumulative-bucket histogram, as in the Prometheus text format.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts (last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe how long the block takes. Works around awaits as well.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                samples.append(('_bucket', key, f'le="{le}"', cumulative))
+            samples.append(('_sum', key, '', total))
+            samples.append(('_count', key, '', count))
+        return samples
+
+    def quantile(self, q, **labels):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in.
+        Returns None before anything was observed.
+        """
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            if state is None:
+                return None
+            counts, _, count = list(state[0]), state[1], state[2]
+        target = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+    def series(self):
+        with self._lock:
+            return {key: (state[1], state[2]) for key, state in self._values.items()}
+
+
+class MetricsRegistry:
+    """
+    Process-wide collection of metrics, rendered in the Prometheus text format.
+    All metrics are thread-safe, so the pipeline's event loop and its thread
+    pools can update them directly.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics()) + '\n'
+
+    def summary(self):
+        """
+        Human-readable end-of-run summary: counter totals per label and latency
+        count, mean and p50/p99 per histogram series.
+        """
+        lines = []
+        for metric in self.metrics():
+            if isinstance(metric, Counter):
+                for _, key, _, value in metric.samples():
+                    lines.append(f'{metric.name}{_label_text(metric.label_names, key)} = {value:g}')
+            elif isinstance(metric, Histogram):
+                for key, (total, count) in sorted(metric.series().items()):
+                    labels = dict(zip(metric.label_names, key))
+                    lines.append(
+                        f'{metric.name}{_label_text(metric.label_names, key)}: {count} calls, '
+                        f'mean {total / count:.3f}s, p50 <= {metric.quantile(0.5, **labels):g}s, '
+                        f'p99 <= {metric.quantile(0.99, **labels):g}s'
+                    )
+        return '\n'.join(lines)
+
+
+registry = MetricsRegistry()
+
+# pipeline metrics
+SERP_QUERIES = registry.counter('serp_queries_total', 'SERP queries by outcome (fetched, cache_hit, failed)', ('result',))
+SERP_PAGES = registry.counter('serp_pages_total', 'Further SERP result pages by outcome (fetched, failed)', ('result',))
+SERP_LATENCY = registry.histogram('serp_fetch_seconds', 'Time to get the SERP results of one query, including retries')
+URLS_SKIPPED = registry.counter('image_urls_skipped_total', 'Image URLs not fetched because another row saw them first')
+IMAGES_DOWNLOADED = registry.counter('images_downloaded_total', 'Image downloads by outcome (new, duplicate, cached, failed)', ('result',))
+IMAGE_BYTES = registry.counter('image_bytes_downloaded_total', 'Bytes of image data downloaded')
+DOWNLOAD_LATENCY = registry.histogram('image_download_seconds', 'Time to download one image')
+VERDICTS = registry.counter('verdicts_total', 'Images by verdict (accepted, rejected, prefiltered, unscored)', ('verdict',))
+PREFILTER_REJECTIONS = registry.counter('prefilter_rejections_total', 'Images rejected before scoring, by reason', ('reason',))
+RELEVANCE_LATENCY = registry.histogram('relevance_check_seconds', 'Time for one Gemini relevance request', ('mode',))
+UPLOADS = registry.counter('uploads_total', 'Drive uploads by outcome (uploaded, existing, failed)', ('result',))
+UPLOAD_LATENCY = registry.histogram('drive_upload_seconds', 'Time to upload one file to Drive, including retries')
+ROWS_FINISHED = registry.counter('rows_finished_total', 'Spreadsheet rows finished, with or without errors', ('result',))
+IN_FLIGHT = registry.gauge('pipeline_in_flight', 'Work items currently being handled per pipeline stage', ('stage',))
+ROWS_IN_FLIGHT = registry.gauge('pipeline_rows_in_flight', 'Rows between search and completion')
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the run log
+        pass
+
+
+class MetricsExporter:
+    """
+    Publish the registry while a run is in progress.
+
+    With `port` the metrics are served at `http://<host>:<port>/metrics`; with
+    `file_path` they are written to that file every `interval` seconds (and once
+    more on stop), e.g. for the node_exporter textfile collector.
+    """
+
+    def __init__(self, port=0, file_path=None, interval=15.0, host='127.0.0.1'):
+        self.port = port
+        self.file_path = file_path
+        self.interval = interval
+        self.host = host
+        self._server = None
+        self._writer = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self.port:
+            self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, name='metrics-http', daemon=True).start()
+            logging.info(f"Serving metrics at http://{self.host}:{self.port}/metrics")
+        if self.file_path:
+            self._writer = threading.Thread(target=self._write_periodically, name='metrics-file', daemon=True)
+            self._writer.start()
+        return self
+
+    def write_file(self):
+        tmp_path = f'{self.file_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(registry.render())
+        os.replace(tmp_path, self.file_path)
+
+    def _write_periodically(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write_file()
+            except OSError as e:
+                logging.warning(f"Could not write metrics to {self.file_path}: {e}")
+
+    def stop(self):
+        self._stopped.set()
+        if self._writer is not None:
+            self._writer.join()
+            self.write_file()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
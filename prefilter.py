@@ -0,0 +1,164 @@
+from imaging import decode_for_scoring, encode_jpeg
+import importlib
+import math
+
+
+class PrefilterConfig:
+    """
+    Which pre-filter checks run and their thresholds. Passed to the worker
+    processes with every batch, so it must stay picklable.
+
+    `plugins` names modules that register additional checks with
+    `register_check`; they are imported here and again in each worker process.
+    """
+
+    def __init__(self, checks=('file_size', 'resolution', 'aspect_ratio', 'blank'), min_bytes=1024,
+                 max_bytes=25 * 1024 ** 2, min_side=96, max_aspect=4.0, min_entropy=2.0,
+                 onnx_model=None, onnx_threshold=0.5, onnx_input_size=224, plugins=()):
+        self.plugins = tuple(plugins)
+        load_plugins(self.plugins)
+        unknown = [name for name in checks if name not in BYTE_CHECKS and name not in IMAGE_CHECKS]
+        if unknown:
+            raise ValueError(f"Unknown pre-filter checks: {unknown}")
+        self.checks = tuple(checks)
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.min_side = min_side
+        self.max_aspect = max_aspect
+        self.min_entropy = min_entropy
+        self.onnx_model = onnx_model
+        self.onnx_threshold = onnx_threshold
+        self.onnx_input_size = onnx_input_size
+
+
+class Candidate:
+    """
+    An image under review: its bytes, original size and downscaled RGB image.
+    """
+
+    def __init__(self, data, size, image):
+        self.data = data
+        self.size = size
+        self.image = image
+
+
+# name -> check(candidate, config) returning a rejection reason or None;
+# byte checks run before the image is decoded
+BYTE_CHECKS = {}
+IMAGE_CHECKS = {}
+
+
+def load_plugins(modules):
+    for module in modules:
+        importlib.import_module(module)
+
+
+def register_check(name, on_bytes=False):
+    """
+    Register a pre-filter check under `name`, so it can be enabled in the config.
+    Checks run in the worker processes, so register them at import time.
+    """
+    def register(check):
+        (BYTE_CHECKS if on_bytes else IMAGE_CHECKS)[name] = check
+        return check
+    return register
+
+
+@register_check('file_size', on_bytes=True)
+def check_file_size(candidate, config):
+    if len(candidate.data) < config.min_bytes:
+        return 'file_too_small'
+    if len(candidate.data) > config.max_bytes:
+        return 'file_too_large'
+    return None
+
+
+@register_check('resolution')
+def check_resolution(candidate, config):
+    if min(candidate.size) < config.min_side:
+        return 'low_resolution'
+    return None
+
+
+@register_check('aspect_ratio')
+def check_aspect_ratio(candidate, config):
+    width, height = candidate.size
+    if max(width, height) > config.max_aspect * max(1, min(width, height)):
+        return 'aspect_ratio'
+    return None
+
+
+def gray_entropy(image):
+    """
+    Shannon entropy in bits of the grayscale histogram: 0 for a solid colour, 8 at most.
+    """
+    histogram = image.convert('L').histogram()
+    total = sum(histogram)
+    return -sum(count / total * math.log2(count / total) for count in histogram if count)
+
+
+@register_check('blank')
+def check_blank(candidate, config):
+    if gray_entropy(candidate.image) < config.min_entropy:
+        return 'blank'
+    return None
+
+
+_onnx_sessions = {}
+
+
+def _onnx_session(model_path):
+    if model_path not in _onnx_sessions:
+        import onnxruntime
+
+        _onnx_sessions[model_path] = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    return _onnx_sessions[model_path]
+
+
+@register_check('onnx')
+def check_classifier(candidate, config):
+    """
+    Operator-supplied ONNX classifier. The model takes one float32 NCHW RGB
+    image scaled to [0, 1] at `onnx_input_size` and its first output's last value
+    is the probability that the image is a plausible candidate.
+    """
+    import numpy as np
+
+    session = _onnx_session(config.onnx_model)
+    size = config.onnx_input_size
+    pixels = np.asarray(candidate.image.resize((size, size)), dtype=np.float32).transpose(2, 0, 1)[None] / 255.0
+    output = session.run(None, {session.get_inputs()[0].name: pixels})[0]
+    if float(np.ravel(output)[-1]) < config.onnx_threshold:
+        return 'classifier'
+    return None
+
+
+def screen_image(image_data, config, max_edge=512, quality=85):
+    """
+    Run the enabled pre-filter checks on image bytes and, if they all pass,
+    return the image downscaled so its longest edge is at most `max_edge` and
+    re-encoded as JPEG at `quality` for scoring.
+    Returns (scoring bytes, None) or (None, rejection reason).
+
+    Runs in a worker process, so it must stay a top-level, picklable function.
+    """
+    load_plugins(config.plugins)
+    candidate = Candidate(image_data, None, None)
+    for name in config.checks:
+        if name in BYTE_CHECKS:
+            reason = BYTE_CHECKS[name](candidate, config)
+            if reason:
+                return None, reason
+
+    try:
+        candidate.size, candidate.image = decode_for_scoring(image_data, max_edge)
+    except Exception:
+        return None, 'undecodable'
+
+    for name in config.checks:
+        if name in IMAGE_CHECKS:
+            reason = IMAGE_CHECKS[name](candidate, config)
+            if reason:
+                return None, reason
+
+    return encode_jpeg(candidate.image, quality), None
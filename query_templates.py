@@ -0,0 +1,61 @@
+import logging
+import re
+
+
+_PLACEHOLDER = re.compile(r'\[([^\[\]]+)\]')
+
+
+class QueryTemplates:
+    """
+    Search query templates compiled once for a fixed set of keywords.
+
+    Each `[keyword]` placeholder is turned into a positional `str.format` field,
+    so a query is built in a single pass instead of one `str.replace` per
+    keyword. Placeholders that do not name one of `keys` (including ones that
+    only differ in case) raise ValueError when the templates are compiled.
+    """
+
+    def __init__(self, templates, keys):
+        self.templates = list(templates)
+        self.keys = list(keys)
+        positions = {key: position for position, key in enumerate(self.keys)}
+
+        self._formats = []
+        for template in self.templates:
+            unknown = [name for name in _PLACEHOLDER.findall(template) if name not in positions]
+            if unknown:
+                raise ValueError(f"Unresolved placeholders {unknown} in query template: {template!r}")
+            escaped = template.replace('{', '{{').replace('}', '}}')
+            self._formats.append(_PLACEHOLDER.sub(lambda match: f'{{{positions[match.group(1)]}}}', escaped))
+
+    @staticmethod
+    def _text(value):
+        # missing cells expand to nothing rather than 'nan'
+        return '' if value is None or value != value else str(value)
+
+    def expand(self, keywords):
+        """
+        Build the queries for one keywords dict, dropping duplicates.
+        """
+        values = [self._text(keywords[key]) for key in self.keys]
+        return self._render(values)
+
+    def _render(self, values):
+        queries = {}
+        for query_format in self._formats:
+            query = ' '.join(query_format.format(*values).split())
+            queries[query] = None
+        return list(queries)
+
+    def expand_table(self, keyword_table):
+        """
+        Build the queries for every row of a keyword DataFrame in one pass over its
+        columns. Returns one query list per row, in row order.
+        """
+        columns = [keyword_table[key].tolist() for key in self.keys]
+        per_row = [self._render([self._text(value) for value in values]) for values in zip(*columns)]
+
+        total = sum(len(queries) for queries in per_row)
+        unique = len({query for queries in per_row for query in queries})
+        logging.info(f"Expanded {len(per_row)} rows into {total} queries ({unique} unique)")
+        return per_row
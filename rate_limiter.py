@@ -0,0 +1,238 @@
+from contextlib import asynccontextmanager, contextmanager
+import threading
+import asyncio
+import logging
+import time
+import os
+
+
+# per-backend defaults: requests per second, burst size, starting/maximum concurrency
+# and the latency above which a response counts as congestion (0 disables it)
+BACKEND_DEFAULTS = {
+    'serp': {'rate': 5.0, 'burst': 10, 'concurrency': 8, 'max_concurrency': 32, 'latency_target': 20.0},
+    'gemini': {'rate': 1.0, 'burst': 5, 'concurrency': 4, 'max_concurrency': 16, 'latency_target': 30.0},
+    'drive': {'rate': 10.0, 'burst': 20, 'concurrency': 4, 'max_concurrency': 16, 'latency_target': 0.0},
+}
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def error_status(error):
+    """
+    Best-effort HTTP status of an exception raised by requests, aiohttp, googleapiclient or google-api-core.
+    """
+    for attr in ('status', 'code', 'status_code'):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    for attr in ('resp', 'response'):
+        response = getattr(error, attr, None)
+        value = getattr(response, 'status', None) or getattr(response, 'status_code', None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header given in seconds. HTTP dates are ignored.
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second, holding at most `burst` tokens.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """
+        Take a token if one is available and return 0, otherwise return the seconds until one is.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Permit:
+    """
+    A granted request slot. Callers set `status` and `retry_after` from the response.
+    """
+
+    def __init__(self):
+        self.status = None
+        self.retry_after = None
+        self.started = time.monotonic()
+
+
+class AdaptiveLimiter:
+    """
+    Rate and concurrency limiter for one backend.
+
+    Requests are paced by a token bucket and capped by a concurrency limit that
+    adapts AIMD-style: it grows additively after successful responses and is cut
+    multiplicatively on 429/5xx responses or latency above `latency_target`, at
+    most once per `cooldown` seconds. A Retry-After value pauses the whole
+    backend. The limiter is thread-safe and can be used from both sync code
+    (`slot`) and asyncio (`async_slot`).
+    """
+
+    def __init__(self, name, rate, burst, concurrency, max_concurrency, latency_target=0,
+                 min_concurrency=1, decrease_factor=0.5, cooldown=2.0, poll_interval=0.05):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.poll_interval = poll_interval
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self):
+        """
+        Claim a slot and return 0, or return how long to wait before trying again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.in_flight >= max(self.min_concurrency, int(self.limit)):
+                return self.poll_interval
+            wait = self.bucket.take(now)
+            if wait:
+                return wait
+            self.in_flight += 1
+            return 0.0
+
+    def _release(self, permit):
+        now = time.monotonic()
+        latency = now - permit.started
+        status = permit.status
+        with self._lock:
+            self.in_flight -= 1
+            if permit.retry_after:
+                self.blocked_until = max(self.blocked_until, now + permit.retry_after)
+
+            congested = status in RETRYABLE_STATUSES or bool(self.latency_target and latency > self.latency_target)
+            if congested:
+                if now - self._last_decrease > self.cooldown:
+                    self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+                    logging.warning(f"{self.name} limiter backing off to {self.limit:.1f} concurrent requests (status {status}, {latency:.1f}s)")
+            elif status is None or status < 400:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def pause(self, seconds):
+        """
+        Stop issuing requests to the backend for `seconds`.
+        """
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @contextmanager
+    def slot(self):
+        """
+        Block the calling thread until a request may be sent.
+        """
+        while True:
+            wait = self._try_acquire()
+            if not wait:
+                break
+            time.sleep(wait)
+        permit = Permit()
+        try:
+            yield permit
+        except Exception as e:
+            if permit.status is None:
+                permit.status = error_status(e) or 599
+            raise
+        finally:
+            self._release(permit)
+
+    @asynccontextmanager
+    async def async_slot(self):
+        """
+        Wait on the event loop until a request may be sent.
+        """
+        while True:
+            wait = self._try_acquire()
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+        permit = Permit()
+        try:
+            yield permit
+        except Exception as e:
+            if permit.status is None:
+                permit.status = error_status(e) or 599
+            raise
+        finally:
+            self._release(permit)
+
+    def call(self, func, *args, retries=4, backoff=2.0, **kwargs):
+        """
+        Call a blocking function under the limiter, retrying 429/5xx errors with backoff.
+        """
+        for attempt in range(retries + 1):
+            try:
+                with self.slot():
+                    return func(*args, **kwargs)
+            except Exception as e:
+                status = error_status(e)
+                if status not in RETRYABLE_STATUSES or attempt == retries:
+                    raise
+                delay = backoff * 2 ** attempt
+                logging.warning(f"{self.name} returned {status}, retrying in {delay:.0f}s")
+                self.pause(delay)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_process_share = 1
+
+
+def set_process_share(processes):
+    """
+    Split the configured rate, burst and concurrency evenly between `processes`
+    worker processes on this machine. Must be called before the first `get_limiter`.
+    """
+    global _process_share
+    _process_share = max(1, int(processes))
+
+
+def get_limiter(backend):
+    """
+    Return the process-wide limiter for a backend ('serp', 'gemini' or 'drive').
+    Defaults can be overridden with `<backend>_rate`, `<backend>_burst`,
+    `<backend>_concurrency`, `<backend>_max_concurrency` and `<backend>_latency_target`
+    environment variables.
+    """
+    with _limiters_lock:
+        if backend not in _limiters:
+            settings = {
+                key: type(default)(os.getenv(f'{backend}_{key}', default))
+                for key, default in BACKEND_DEFAULTS[backend].items()
+            }
+            if _process_share > 1:
+                settings['rate'] /= _process_share
+                for key in ('burst', 'concurrency', 'max_concurrency'):
+                    settings[key] = max(1, settings[key] // _process_share)
+            _limiters[backend] = AdaptiveLimiter(backend, **settings)
+        return _limiters[backend]
@@ -0,0 +1,233 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import deque
+from rate_limiter import RETRYABLE_STATUSES, error_status
+import threading
+import asyncio
+import logging
+import random
+import time
+
+
+class RequestFailed(Exception):
+    """
+    A response that did not carry a usable result, e.g. a non-200 SERP response.
+    """
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class LatencyTracker:
+    """
+    Rolling window of successful request latencies.
+    """
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def quantile(self, q):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class RequestPolicy:
+    """
+    Timeouts, retries and hedging for one kind of request.
+
+    Each attempt gets `attempt_timeout` seconds and all attempts together get
+    `total_timeout`. Timeouts, connection errors and retryable statuses are
+    retried up to `max_retries` times with jittered exponential backoff (or the
+    server's Retry-After, if longer). With `hedge` on, once `hedge_min_samples`
+    latencies have been seen, an attempt that is still running after the
+    `hedge_quantile` latency gets a duplicate request, and whichever finishes
+    first wins.
+
+    `call` runs blocking attempt functions on a small thread pool so that the
+    timeouts hold even while a response is streaming; `run` does the same for
+    coroutine functions on the event loop.
+    """
+
+    def __init__(self, name, attempt_timeout=30.0, total_timeout=120.0, max_retries=3,
+                 backoff_base=1.0, backoff_max=30.0, hedge=True, hedge_quantile=0.95,
+                 hedge_min_samples=20, retry_exceptions=(TimeoutError, asyncio.TimeoutError, OSError),
+                 max_workers=8):
+        self.name = name
+        self.attempt_timeout = attempt_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.latency = LatencyTracker()
+        self.max_workers = max_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def is_retryable(self, error):
+        status = error_status(error)
+        if status is not None:
+            return status in RETRYABLE_STATUSES
+        return isinstance(error, self.retry_exceptions)
+
+    def hedge_delay(self):
+        """
+        Seconds to wait before sending a duplicate request, or None while hedging is off
+        or there are too few latency samples.
+        """
+        if not self.hedge or len(self.latency) < self.hedge_min_samples:
+            return None
+        return self.latency.quantile(self.hedge_quantile)
+
+    def backoff(self, attempt, error):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _retry_delay(self, attempt, error, deadline):
+        """
+        Return how long to sleep before the next attempt, or None if the error is final.
+        """
+        if attempt == self.max_retries or not self.is_retryable(error):
+            return None
+        delay = self.backoff(attempt, error)
+        if time.monotonic() + delay >= deadline:
+            return None
+        logging.warning(f"{self.name} attempt {attempt + 1} failed ({error!r}), retrying in {delay:.1f}s")
+        return delay
+
+    # blocking requests
+
+    def _pool(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+            return self._executor
+
+    def _timed(self, func, *args, **kwargs):
+        started = time.monotonic()
+        result = func(*args, **kwargs)
+        self.latency.add(time.monotonic() - started)
+        return result
+
+    def _attempt(self, func, args, kwargs, timeout):
+        pool = self._pool()
+        deadline = time.monotonic() + timeout
+        futures = {pool.submit(self._timed, func, *args, **kwargs)}
+        delay = self.hedge_delay()
+        if delay is not None and delay < timeout:
+            done, _ = wait(futures, timeout=delay)
+            if not done:
+                logging.info(f"{self.name} hedging a request still running after {delay:.1f}s")
+                futures.add(pool.submit(self._timed, func, *args, **kwargs))
+
+        error = None
+        while futures:
+            done, futures = wait(futures, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    for other in futures:
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+        if error is not None and not futures:
+            raise error
+        # abandoned attempts finish on their own, bounded by the client's own timeout
+        raise TimeoutError(f"{self.name} attempt timed out after {timeout:.1f}s")
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call a blocking function under the policy and return its result, or raise the last error.
+        """
+        deadline = time.monotonic() + self.total_timeout
+        for attempt in range(self.max_retries + 1):
+            timeout = min(self.attempt_timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise TimeoutError(f"{self.name} gave up after {self.total_timeout:.1f}s")
+            try:
+                return self._attempt(func, args, kwargs, timeout)
+            except Exception as e:
+                delay = self._retry_delay(attempt, e, deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    # coroutines
+
+    async def _timed_async(self, func, *args, **kwargs):
+        started = time.monotonic()
+        result = await func(*args, **kwargs)
+        self.latency.add(time.monotonic() - started)
+        return result
+
+    async def _attempt_async(self, func, args, kwargs, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        tasks = {asyncio.ensure_future(self._timed_async(func, *args, **kwargs))}
+        try:
+            delay = self.hedge_delay()
+            if delay is not None and delay < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    logging.info(f"{self.name} hedging a request still running after {delay:.1f}s")
+                    tasks.add(asyncio.ensure_future(self._timed_async(func, *args, **kwargs)))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            if error is not None and not tasks:
+                raise error
+            raise asyncio.TimeoutError(f"{self.name} attempt timed out after {timeout:.1f}s")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Await a coroutine function under the policy and return its result, or raise the last error.
+        """
+        deadline = time.monotonic() + self.total_timeout
+        for attempt in range(self.max_retries + 1):
+            timeout = min(self.attempt_timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise asyncio.TimeoutError(f"{self.name} gave up after {self.total_timeout:.1f}s")
+            try:
+                return await self._attempt_async(func, args, kwargs, timeout)
+            except Exception as e:
+                delay = self._retry_delay(attempt, e, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
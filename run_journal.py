@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# Row keys move through 'searched' -> 'done', image keys through 'downloaded' -> 'scored' -> 'uploaded'.
+STAGES = ('searched', 'downloaded', 'scored', 'uploaded', 'done')
+
+
+def image_key(image_url):
+    """
+    Short, stable journal key for an image URL (data URIs can be hundreds of KB).
+    """
+    return hashlib.sha1(image_url.encode('utf-8')).hexdigest()[:20]
+
+
+class RunJournal:
+    """
+    Durable record of how far each (sheet, row, image) got in a run.
+
+    Records are appended as JSON lines in batches of `flush_every`, and the latest
+    record per key is kept in memory. When the log holds more than
+    `compact_ratio` lines per live key it is rewritten with one line per key.
+
+    With `shared=True` several worker processes append to the same file: appends
+    take an exclusive lock, `refresh` picks up records other processes wrote,
+    and the file is only compacted by an explicit `compact` call while no
+    workers are running.
+    """
+
+    def __init__(self, path, flush_every=50, compact_ratio=4, shared=False):
+        self.path = path
+        self.flush_every = flush_every
+        self.compact_ratio = compact_ratio
+        self.shared = shared
+        self._entries = {}
+        self._buffer = []
+        self._lines = 0
+        self._offset = 0
+        self._load()
+
+    @staticmethod
+    def _key(sheet, row, image=None):
+        return f'{sheet}|{row}|{image or ""}'
+
+    def _load(self):
+        """
+        Replay the journal file into memory. A torn last line from a crash is ignored.
+        """
+        self.refresh()
+        logging.info(f"Run journal loaded {len(self._entries)} entries from {self.path}")
+
+    def refresh(self):
+        """
+        Replay the complete lines appended to the file since it was last read.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            self._apply(record)
+            self._lines += 1
+        self._offset += end
+
+    def _apply(self, record):
+        key = record['key']
+        current = self._entries.get(key)
+        if current is None or STAGES.index(record['stage']) >= STAGES.index(current['stage']):
+            self._entries[key] = record
+
+    def get(self, sheet, row, image=None):
+        """
+        Return the latest record for a key, or None if it was never journaled.
+        """
+        return self._entries.get(self._key(sheet, row, image))
+
+    def stage(self, sheet, row, image=None):
+        """
+        Return the latest completed stage for a key, or None.
+        """
+        record = self.get(sheet, row, image)
+        return record['stage'] if record else None
+
+    def images(self):
+        """
+        Yield (sheet, row, image, record) for the latest record of every image key.
+        Rows are returned as journaled, i.e. as strings.
+        """
+        for key, record in list(self._entries.items()):
+            sheet, row, image = key.rsplit('|', 2)
+            if image:
+                yield sheet, row, image, record
+
+    def record(self, sheet, row, stage, image=None, **fields):
+        """
+        Record that a key completed `stage`, with optional extra fields such as the digest or verdict.
+        """
+        record = dict(fields, key=self._key(sheet, row, image), stage=stage)
+        self._apply(record)
+        self._buffer.append(json.dumps(record, ensure_ascii=False))
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Append buffered records to disk and compact the file when it has grown too large.
+        """
+        if not self._buffer:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            if self.shared and fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.write('\n'.join(self._buffer) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            end = f.tell()
+        written = len(self._buffer)
+        self._buffer = []
+
+        if self.shared:
+            # other processes may have appended before us, so our own lines are
+            # read back by the next refresh along with theirs
+            return
+        self._lines += written
+        self._offset = end
+
+        if self._lines > self.compact_ratio * max(len(self._entries), 1000):
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal with only the latest record per key.
+        """
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in self._entries.values():
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._lines = len(self._entries)
+        self._offset = os.path.getsize(self.path)
+        logging.info(f"Run journal compacted to {self._lines} entries")
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,65 @@
+import logging
+import json
+import time
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class ResultsWriter:
+    """
+    Append-only JSONL log of what happened to every image of a run.
+
+    One compact record per image (row, query, image URL and digest, source page,
+    verdict, pre-filter rejection reason, score and Drive file ID) is buffered
+    in memory only until the row it belongs to finishes, then appended to the file. Memory therefore stays
+    flat however large the sheet is, and a crash loses at most the rows still
+    in flight. Appends take an exclusive lock so several worker processes can
+    share the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+        self._buffer = []
+
+    def add(self, sheet, row, image_url, digest, verdict, query=None, source=None, link=None, score=None, drive_id=None,
+            reason=None):
+        record = {
+            'sheet': sheet,
+            'row': row,
+            'query': query,
+            # inline data URIs would bloat the log; the digest identifies them
+            'image_url': None if image_url.startswith('data:') else image_url,
+            'digest': digest,
+            'source': source,
+            'link': link,
+            'verdict': verdict,
+            'reason': reason,
+            'score': score,
+            'drive_id': drive_id,
+            'time': round(time.time(), 3)
+        }
+        self._buffer.append(json.dumps(record, ensure_ascii=False))
+
+    def flush(self):
+        """
+        Append the buffered records to disk.
+        """
+        if not self._buffer:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.write('\n'.join(self._buffer) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.written += len(self._buffer)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        logging.info(f"Wrote {self.written} result records to {self.path}")
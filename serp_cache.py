@@ -0,0 +1,100 @@
+import hashlib
+import logging
+import json
+import time
+import os
+
+
+class SerpCache:
+    """
+    On-disk cache of SERP responses.
+
+    Each response is stored as `<cache_dir>/<key[:2]>/<key>.json`, where the key
+    is the SHA-256 of the normalized query and the search parameters (`gl`,
+    `uule`, `num`, ...). Entries older than `ttl` seconds are treated as misses,
+    and once the cache grows past `max_bytes` the oldest entries are evicted.
+    """
+
+    def __init__(self, cache_dir, ttl=7 * 24 * 3600, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def key(query, params):
+        """
+        Build the cache key from the query and the parameters that change the result set.
+        """
+        normalized_query = ' '.join(query.split()).lower()
+        payload = json.dumps([normalized_query, sorted(params.items())], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def _entries(self):
+        """
+        Yield (path, size, mtime) for every cached response.
+        """
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    yield path, stat.st_size, stat.st_mtime
+
+    def get(self, query, params):
+        """
+        Return the cached response for a query, or None if it is missing or expired.
+        """
+        path = self._path(self.key(query, params))
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                self._remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, query, params, response):
+        """
+        Cache a response and evict old entries if the cache is over its size limit.
+        """
+        path = self._path(self.key(query, params))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(response, f, ensure_ascii=False)
+        if os.path.exists(path):
+            self._size -= os.path.getsize(path)
+        os.replace(tmp_path, path)
+        self._size += os.path.getsize(path)
+
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self._size -= size
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Drop expired entries, then the oldest ones until the cache fits in `max_bytes`.
+        """
+        now = time.time()
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        removed = 0
+        for path, size, mtime in entries:
+            if now - mtime <= self.ttl and self._size <= self.max_bytes:
+                break
+            self._remove(path)
+            removed += 1
+        if removed:
+            logging.info(f"SERP cache evicted {removed} entries")
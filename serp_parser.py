@@ -0,0 +1,184 @@
+from typing import NamedTuple
+import json
+import re
+
+
+class SerpImage(NamedTuple):
+    """
+    The fields of a SERP `images[*]` entry the pipeline uses.
+    """
+    image: str
+    link: str
+    title: str
+    source: str
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(entry.get('image'), entry.get('link'), entry.get('title'), entry.get('source'))
+
+
+# bytes that can change the parser state outside of a string
+_STRUCTURE = re.compile(rb'["{}\[\]:,]')
+# bytes that can end or escape a string
+_STRING_END = re.compile(rb'["\\]')
+
+
+class ImagesExtractor:
+    """
+    Incremental parser that pulls `images[*]` out of a SERP JSON body as it arrives.
+
+    Only the structure of the document is tracked. Strings are skipped with a
+    regex search, so the large `html` and `navigation` values and inline data
+    URIs are never decoded or buffered. Each entry of the top-level `images`
+    array is decoded on its own and reduced to a SerpImage, so memory use is
+    bounded by the largest single image entry rather than the whole response.
+    The small top-level `pagination` object is decoded as well.
+    """
+
+    def __init__(self):
+        self.images = []
+        self.pagination = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expect_key = False
+        self._key = None
+        self._last_key = None
+        self._current_key = None
+        self._images_open = False
+        self._element = None
+        self._element_depth = None
+
+    def feed(self, chunk):
+        """
+        Parse the next chunk of the response body.
+        """
+        pos = 0
+        end = len(chunk)
+        element_start = 0 if self._element is not None else None
+
+        while pos < end:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    if self._key is not None:
+                        self._key += chunk[pos:pos + 1]
+                    pos += 1
+                    continue
+                match = _STRING_END.search(chunk, pos)
+                if match is None:
+                    if self._key is not None:
+                        self._key += chunk[pos:]
+                    break
+                if self._key is not None:
+                    self._key += chunk[pos:match.start()]
+                pos = match.end()
+                if match.group() == b'\\':
+                    if self._key is not None:
+                        self._key += b'\\'
+                    self._escape = True
+                    continue
+                self._in_string = False
+                if self._key is not None:
+                    self._last_key = bytes(self._key)
+                    self._key = None
+                continue
+
+            match = _STRUCTURE.search(chunk, pos)
+            if match is None:
+                break
+            char = match.group()
+            pos = match.end()
+
+            if char == b'"':
+                self._in_string = True
+                if self._depth == 1 and self._expect_key:
+                    self._key = bytearray()
+            elif char in (b'{', b'['):
+                if char == b'{' and self._element is None and (
+                        (self._images_open and self._depth == 2)
+                        or (self._depth == 1 and self._current_key == b'pagination')):
+                    self._element = bytearray()
+                    self._element_depth = self._depth
+                    element_start = match.start()
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect_key = char == b'{'
+                elif self._depth == 2 and char == b'[' and self._current_key == b'images':
+                    self._images_open = True
+            elif char in (b'}', b']'):
+                self._depth -= 1
+                if self._element is not None and self._depth == self._element_depth:
+                    self._element += chunk[element_start:pos]
+                    if self._depth == 1:
+                        self._emit_pagination(self._element)
+                    else:
+                        self._emit(self._element)
+                    self._element = None
+                    element_start = None
+                elif self._images_open and self._depth == 1:
+                    self._images_open = False
+            elif self._depth == 1:
+                if char == b':':
+                    self._current_key = self._last_key
+                    self._expect_key = False
+                else:
+                    self._expect_key = True
+
+        if self._element is not None and element_start is not None:
+            self._element += chunk[element_start:]
+
+    def _emit(self, element):
+        try:
+            entry = json.loads(element)
+        except ValueError:
+            return
+        if isinstance(entry, dict) and entry.get('image'):
+            self.images.append(SerpImage.from_dict(entry))
+
+    def _emit_pagination(self, element):
+        try:
+            pagination = json.loads(element)
+        except ValueError:
+            return
+        if isinstance(pagination, dict):
+            self.pagination = pagination
+
+
+def extract_images(body):
+    """
+    Extract the image records from a complete SERP body (bytes).
+    """
+    extractor = ImagesExtractor()
+    extractor.feed(body)
+    return extractor.images
+
+
+def page_starts(pagination, max_pages):
+    """
+    The `start` offsets of the further result pages a SERP `pagination` block
+    announces, up to page `max_pages`, in page order.
+    """
+    if not pagination:
+        return []
+    starts = {}
+    for page in pagination.get('pages') or []:
+        if isinstance(page, dict) and page.get('start') is not None and page.get('page') is not None:
+            starts[int(page['page'])] = int(page['start'])
+    if pagination.get('next_page') is not None and pagination.get('next_page_start') is not None:
+        starts.setdefault(int(pagination['next_page']), int(pagination['next_page_start']))
+    return [start for page, start in sorted(starts.items()) if page <= max_pages]
+
+
+def images_to_json(images):
+    """
+    Compact, SERP-shaped form of the image records for caching.
+    """
+    return {'images': [image._asdict() for image in images]}
+
+
+def images_from_json(data):
+    """
+    Rebuild image records from a cached response (compact or a full SERP body).
+    """
+    return [SerpImage.from_dict(entry) for entry in data.get('images', []) if entry.get('image')]
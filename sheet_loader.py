@@ -0,0 +1,156 @@
+import importlib.util
+import hashlib
+import logging
+import json
+import os
+
+
+# Excel column -> keyword name used in the query templates
+PLAGAS_KEYWORD_COLUMNS = {
+    'Tipo': 'Tipo',
+    'Subtipo': 'Subtipo',
+    'Nombre Común': 'nombre_común',
+    'Nombre Científico': 'Nombre Científico',
+    'Parte Afectada': 'parte_afectada',
+    'Especie Afectada': 'especies_afectadas',
+    'Daño': 'Daño'
+}
+DEFICI_KEYWORDS = ('disorder', 'characteristic', 'affected_part')
+PLAGAS_KEYWORD_DEFAULTS = {
+    'parte_afectada': 'plant body',
+    'especies_afectadas': 'citrus plant',
+    'Daño': 'damage'
+}
+
+
+def file_sha256(path):
+    """
+    Return the hex SHA-256 digest of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def preprocess_sheet(data, sheet_name):
+    """
+    Apply the per-sheet cleanup to a freshly read sheet.
+    """
+    if sheet_name == 'Plagas':
+        data = data.drop(data.columns[:2], axis=1).reset_index(drop=True)
+    elif sheet_name == 'Deficiencias':
+        data = data.rename(columns={data.columns[0]: 'disorders'})
+    else:
+        raise ValueError(f"Sheet name '{sheet_name}' not recognized.")
+    return data
+
+
+def _write_snapshot(data, path):
+    """
+    Write a sheet as Parquet when pyarrow is available and can represent it,
+    otherwise as a pickle. Returns the format used.
+    """
+    if importlib.util.find_spec('pyarrow') is not None:
+        try:
+            data.to_parquet(f'{path}.parquet')
+            return 'parquet'
+        except Exception as e:
+            # e.g. columns mixing numbers and text
+            logging.info(f"Sheet snapshot falling back to pickle: {e}")
+    data.to_pickle(f'{path}.pkl')
+    return 'pickle'
+
+
+def _read_snapshot(path, snapshot_format):
+    import pandas as pd
+
+    if snapshot_format == 'parquet':
+        return pd.read_parquet(f'{path}.parquet')
+    return pd.read_pickle(f'{path}.pkl')
+
+
+def _write_meta(meta_path, meta):
+    tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def load_sheet(excel_file, sheet_name, cache_dir=None):
+    """
+    Load and preprocess a sheet of the workbook.
+
+    With `cache_dir` the preprocessed sheet is kept as a columnar snapshot next
+    to a small metadata file holding the workbook's mtime, size and SHA-256.
+    The snapshot is reused while the mtime and size are unchanged; if only the
+    mtime changed, the hash decides. Otherwise the workbook is parsed again.
+    """
+    import pandas as pd
+
+    if cache_dir is None:
+        return preprocess_sheet(pd.read_excel(excel_file, header=1, sheet_name=sheet_name), sheet_name)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    snapshot_path = os.path.join(cache_dir, sheet_name)
+    meta_path = f'{snapshot_path}.json'
+    stat = os.stat(excel_file)
+
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+    if meta is not None:
+        digest = None
+        if (meta['mtime_ns'], meta['size']) != (stat.st_mtime_ns, stat.st_size):
+            digest = file_sha256(excel_file)
+        if digest is None or digest == meta['sha256']:
+            try:
+                data = _read_snapshot(snapshot_path, meta['format'])
+            except Exception as e:
+                logging.warning(f"Could not read the snapshot of sheet '{sheet_name}': {e}")
+            else:
+                if digest is not None:
+                    # touched but unchanged: remember the new mtime
+                    meta.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+                    _write_meta(meta_path, meta)
+                logging.info(f"Loaded sheet '{sheet_name}' from its snapshot")
+                return data
+
+    data = preprocess_sheet(pd.read_excel(excel_file, header=1, sheet_name=sheet_name), sheet_name)
+    _write_meta(meta_path, {
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': file_sha256(excel_file),
+        'format': _write_snapshot(data, snapshot_path)
+    })
+    logging.info(f"Parsed sheet '{sheet_name}' from {excel_file} and saved a snapshot")
+    return data
+
+
+def extract_keywords_plagas(df):
+    """
+    Keywords for every row of the 'Plagas' sheet, one column per query placeholder.
+    Missing affected part, species and damage get generic defaults.
+    """
+    return df[list(PLAGAS_KEYWORD_COLUMNS)].rename(columns=PLAGAS_KEYWORD_COLUMNS).fillna(PLAGAS_KEYWORD_DEFAULTS)
+
+
+def extract_keywords_defici(df):
+    """
+    Keywords for every characteristic row of the 'Deficiencias' sheet.
+    Rows without a characteristic name the disorder for the rows below them.
+    """
+    import pandas as pd
+
+    is_disorder = df["Característica"].isna()
+    disorders = df["disorders"].where(is_disorder).ffill()
+    rows = ~is_disorder
+    return pd.DataFrame({
+        # keys match DEFICI_KEYWORDS
+        'disorder': disorders[rows],
+        'characteristic': df.loc[rows, "Característica"],
+        'affected_part': df.loc[rows, "Parte Afectada"].fillna('plant body')
+    })
@@ -0,0 +1,78 @@
+import threading
+import unittest
+import tempfile
+import shutil
+import types
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+main_async = None
+
+
+def setUpModule():
+    # main_async creates its Images/ and logs/ folders in the working directory on import
+    global main_async, _start_directory, _work_directory
+    _start_directory = os.getcwd()
+    _work_directory = tempfile.mkdtemp(prefix='images-test-')
+    os.chdir(_work_directory)
+    import main_async as module
+    main_async = module
+
+
+def tearDownModule():
+    os.chdir(_start_directory)
+    shutil.rmtree(_work_directory, ignore_errors=True)
+
+
+class FakeDriveIndex:
+
+    def __init__(self, service, parent_folder_id, path):
+        self.service = service
+
+    def load(self):
+        return self
+
+
+class FakeDriveUploader:
+
+    def __init__(self, creds, max_workers, index, root_url=None):
+        self.index = index
+
+
+class LazyClientsTest(unittest.TestCase):
+
+    def setUp(self):
+        stubs = {
+            'google_drive.google_drive_client': types.SimpleNamespace(authenticate_drive=lambda creds, root_url=None: 'service'),
+            'google_drive.namespace_index': types.SimpleNamespace(DriveNamespaceIndex=FakeDriveIndex),
+            'google_drive.uploader': types.SimpleNamespace(DriveUploader=FakeDriveUploader),
+        }
+        self._saved = {name: sys.modules.get(name) for name in stubs}
+        sys.modules.update(stubs)
+        main_async._clients.clear()
+
+    def tearDown(self):
+        main_async._clients.clear()
+        for name, module in self._saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def test_get_uploader_builds_its_dependencies(self):
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(uploader=main_async.get_uploader()), daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'get_uploader() deadlocked')
+
+        uploader = result['uploader']
+        self.assertIs(uploader.index, main_async.get_drive_index())
+        self.assertEqual(uploader.index.service, 'service')
+        self.assertIs(main_async.get_uploader(), uploader)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+from urllib.parse import parse_qsl, quote, unquote, urlencode, urlsplit
+import threading
+import hashlib
+import logging
+import sqlite3
+import time
+import re
+
+
+# query parameters that only track the click or pick a rendition of the same image
+IGNORED_PARAMS = re.compile(
+    r'^(utm_\w+|fbclid|gclid|dclid|msclkid|mc_cid|mc_eid|igshid|_ga|ref_src|'
+    r'w|h|width|height|resize|fit|crop|quality|dpr|auto|fm|ixlib|ixid|itok|v|ver)$',
+    re.IGNORECASE
+)
+# size suffixes CDNs and CMSs add to the file name, e.g. photo-300x200.jpg (WordPress),
+# photo_large.jpg or photo_600x.jpg (Shopify) and photo@2x.jpg
+SIZE_SUFFIX = re.compile(
+    r'(-\d+x\d+|_(\d+x\d*|x\d+|pico|icon|thumb|small|compact|medium|large|grande|master|original))?'
+    r'(@\dx)?(?=\.[A-Za-z0-9]+$)'
+)
+# Wikimedia thumbnails: /thumb/a/ab/File.jpg/220px-File.jpg -> /a/ab/File.jpg
+WIKIMEDIA_THUMB = re.compile(r'/thumb(/[0-9a-f]/[0-9a-f]{2}/[^/]+)/[^/]*$')
+# Google user content size options: .../photo=s1200 or .../photo=w400-h300-c
+GOOGLE_SIZE = re.compile(r'=[swh]\d+[^/]*$')
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonicalize_url(url):
+    """
+    Reduce an image URL to a form shared by the URLs that serve the same picture:
+    no scheme, fragment, `www.` or default port, a lower-case host, a consistently
+    escaped path without CDN size suffixes, and only the query parameters that
+    are not tracking or resizing options, sorted. Data URIs are returned unchanged.
+
+    The canonical form is only used to recognise repeats; images are still
+    fetched from their original URL.
+    """
+    if url.startswith('data:'):
+        return url
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    if port is not None and port != DEFAULT_PORTS.get(parts.scheme.lower()):
+        host = f'{host}:{port}'
+
+    path = quote(unquote(parts.path), safe="/:@!$&'()*+,;=~")
+    path = WIKIMEDIA_THUMB.sub(r'\1', path)
+    if host.endswith(('googleusercontent.com', 'ggpht.com')):
+        path = GOOGLE_SIZE.sub('', path)
+    path = SIZE_SUFFIX.sub('', path)
+
+    params = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                    if not IGNORED_PARAMS.match(key))
+    query = f'?{urlencode(params)}' if params else ''
+    return f'//{host}{path}{query}'
+
+
+def url_hash(url):
+    """
+    64-bit key of a canonical URL, as a signed integer to fit an SQLite INTEGER.
+    """
+    return int.from_bytes(hashlib.sha256(url.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+
+class SeenUrlIndex:
+    """
+    Run-wide, persistent index of the canonical image URLs seen so far, backed by SQLite.
+
+    Every URL is stored once under its 64-bit hash, the table's integer primary
+    key, together with the (sheet, row) it was first seen under, so lookups stay
+    compact and fast however many rows share it. The canonical URL is kept as
+    well (data URIs as a digest) and compared on every lookup, so a hash
+    collision never hides an image. Every row a URL is seen under is recorded
+    in a separate table. Any number of worker processes can share the file.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS urls (
+                key INTEGER PRIMARY KEY,
+                url TEXT NOT NULL,
+                sheet TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                seen_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS sightings (
+                key INTEGER NOT NULL,
+                sheet TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                PRIMARY KEY (key, sheet, row)
+            ) WITHOUT ROWID"""
+        )
+        logging.info(f"Seen-URL index at {db_path} has {len(self)} URLs")
+
+    @staticmethod
+    def _stored(url):
+        if url.startswith('data:'):
+            return 'data:' + hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return url
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+
+    def claim(self, sheet, row, urls):
+        """
+        Record that the canonical `urls` were seen under (sheet, row), in one transaction.
+        Returns {url: (sheet, row)} for the URLs another row saw first; the rest
+        belong to this row, including those it claimed in an earlier run.
+        """
+        sheet, row, now = str(sheet), int(row), time.time()
+        entries = {url_hash(url): (url, self._stored(url)) for url in urls}
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO urls (key, url, sheet, row, seen_at) VALUES (?, ?, ?, ?, ?)",
+                    [(key, stored, sheet, row, now) for key, (_, stored) in entries.items()]
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO sightings (key, sheet, row) VALUES (?, ?, ?)",
+                    [(key, sheet, row) for key in entries]
+                )
+                owners = {}
+                keys = list(entries)
+                # stay below SQLite's limit on bound parameters
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start:start + 500]
+                    for key, stored, owner_sheet, owner_row in self._conn.execute(
+                        f"SELECT key, url, sheet, row FROM urls WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                    ):
+                        owners[key] = stored, owner_sheet, owner_row
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        seen_elsewhere = {}
+        for key, (url, stored) in entries.items():
+            owner_stored, owner_sheet, owner_row = owners[key]
+            if owner_stored == stored and (owner_sheet, owner_row) != (sheet, row):
+                seen_elsewhere[url] = (owner_sheet, owner_row)
+        return seen_elsewhere
+
+    def rows(self, url):
+        """
+        Return the (sheet, row) pairs a canonical URL was seen under, first sighting first.
+        """
+        key = url_hash(url)
+        with self._lock:
+            owner = self._conn.execute("SELECT url, sheet, row FROM urls WHERE key=?", (key,)).fetchone()
+            if owner is None or owner[0] != self._stored(url):
+                return []
+            sightings = self._conn.execute("SELECT sheet, row FROM sightings WHERE key=?", (key,)).fetchall()
+        first = (owner[1], owner[2])
+        return [first] + sorted(sighting for sighting in sightings if sighting != first)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
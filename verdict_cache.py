@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+
+class VerdictCache:
+    """
+    Persistent cache of Gemini relevance verdicts backed by SQLite.
+
+    Verdicts are keyed by (image digest, normalized prompt, model name) and store
+    the raw score and `Final_Verdict`, so the relevance threshold is applied when
+    a verdict is read and changing it takes effect without re-scoring. Entries
+    expire after `ttl` seconds and the oldest entries are evicted whenever the
+    cache grows past `max_entries` rows. Verdicts from any other model are dropped
+    when the cache is opened.
+    """
+
+    def __init__(self, db_path, model_name, ttl=30 * 24 * 3600, max_entries=500000):
+        self.db_path = db_path
+        self.model_name = model_name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS verdicts (
+                digest TEXT NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                score INTEGER NOT NULL,
+                verdict TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (digest, prompt_hash, model)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS verdicts_created_at ON verdicts (created_at)")
+        self._entries = 0
+        self.invalidate_other_models()
+        self.evict()
+
+    @staticmethod
+    def prompt_hash(prompt):
+        """
+        Hash the prompt after collapsing whitespace so indentation changes do not miss the cache.
+        """
+        normalized = ' '.join(prompt.split()).lower()
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def get(self, digest, prompt):
+        """
+        Return (score, verdict) for a cached, unexpired verdict, otherwise None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT score, verdict, created_at FROM verdicts WHERE digest=? AND prompt_hash=? AND model=?",
+                (digest, self.prompt_hash(prompt), self.model_name)
+            ).fetchone()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+        return row[0], row[1]
+
+    def put(self, digest, prompt, score, verdict):
+        """
+        Store the verdict for an image/prompt pair.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, self.prompt_hash(prompt), self.model_name, score, verdict, time.time())
+            )
+            self._conn.commit()
+            # replaced rows are counted too; evict() recounts
+            self._entries += 1
+        if self._entries > self.max_entries:
+            # trim a little below the limit so the next puts do not evict one row at a time
+            self.evict(self.max_entries - self.max_entries // 100)
+
+    def invalidate_other_models(self):
+        """
+        Drop verdicts produced by any model other than the current one.
+        """
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM verdicts WHERE model != ?", (self.model_name,)).rowcount
+            self._conn.commit()
+        if deleted:
+            logging.info(f"Verdict cache invalidated {deleted} entries from other models")
+
+    def evict(self, keep=None):
+        """
+        Remove expired entries and trim the cache down to `keep` entries (`max_entries` by default).
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM verdicts WHERE created_at < ?", (time.time() - self.ttl,))
+            self._conn.execute(
+                """DELETE FROM verdicts WHERE rowid IN (
+                    SELECT rowid FROM verdicts ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries if keep is None else keep,)
+            )
+            self._conn.commit()
+            self._entries = self._conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,175 @@
+import threading
+import logging
+import sqlite3
+import json
+import time
+
+
+class WorkQueue:
+    """
+    Lease-based task queue backed by SQLite, shared by worker processes.
+
+    A worker claims a task by taking a lease on it for `lease_seconds`, extends
+    the lease while it is still working on it, and then completes or fails it.
+    Leases that expire (e.g. because the worker crashed) put the task back in
+    the queue. Failed tasks are retried until they have been attempted
+    `max_attempts` times. Any number of processes can share the file on one
+    machine; across machines the file must live on a filesystem with working
+    SQLite locking.
+    """
+
+    def __init__(self, db_path, lease_seconds=600, max_attempts=3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                result TEXT,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires)")
+
+    def enqueue(self, tasks):
+        """
+        Add (task_id, payload) pairs. Tasks that already exist keep their status and
+        attempts but take the new payload. Returns the number of tasks in the queue file.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "INSERT INTO tasks (id, payload, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET payload=excluded.payload",
+                [(task_id, json.dumps(payload, ensure_ascii=False), now) for task_id, payload in tasks]
+            )
+            self._conn.execute("COMMIT")
+            return self._conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+    def requeue_expired(self):
+        """
+        Put tasks whose lease has expired back in the queue, or mark them failed
+        once they have used up their attempts (e.g. a task that keeps crashing its worker).
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                failed = self._conn.execute(
+                    "UPDATE tasks SET status='failed', lease_owner=NULL, lease_expires=NULL, result=?, updated_at=? "
+                    "WHERE status='leased' AND lease_expires < ? AND attempts >= ?",
+                    (json.dumps({'error': 'lease expired'}), now, now, self.max_attempts)
+                ).rowcount
+                requeued = self._conn.execute(
+                    "UPDATE tasks SET status='queued', lease_owner=NULL, lease_expires=NULL, updated_at=? "
+                    "WHERE status='leased' AND lease_expires < ?",
+                    (now, now)
+                ).rowcount
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if failed:
+            logging.error(f"Failed {failed} tasks whose leases expired on their last attempt")
+        if requeued:
+            logging.warning(f"Re-queued {requeued} tasks with expired leases")
+        return requeued
+
+    def claim(self, worker_id):
+        """
+        Lease the next queued task for `worker_id`. Returns (task_id, payload), or None
+        when nothing is queued.
+        """
+        self.requeue_expired()
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, payload FROM tasks WHERE status='queued' ORDER BY rowid LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE tasks SET status='leased', lease_owner=?, lease_expires=?, attempts=attempts+1, "
+                        "updated_at=? WHERE id=?",
+                        (worker_id, now + self.lease_seconds, now, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def extend(self, task_ids, worker_id):
+        """
+        Renew the leases `worker_id` holds on these tasks.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE tasks SET lease_expires=?, updated_at=? WHERE id=? AND status='leased' AND lease_owner=?",
+                [(now + self.lease_seconds, now, task_id, worker_id) for task_id in task_ids]
+            )
+
+    def complete(self, task_id, worker_id, result=None):
+        """
+        Mark a leased task as done.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tasks SET status='done', lease_owner=NULL, lease_expires=NULL, result=?, updated_at=? "
+                "WHERE id=? AND lease_owner=?",
+                (json.dumps(result, ensure_ascii=False), time.time(), task_id, worker_id)
+            )
+
+    def fail(self, task_id, worker_id, error=None):
+        """
+        Release a leased task after a failed attempt. It is queued again unless it
+        has used up its attempts.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tasks SET status=CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                "lease_owner=NULL, lease_expires=NULL, result=?, updated_at=? WHERE id=? AND lease_owner=?",
+                (self.max_attempts, json.dumps({'error': error}, ensure_ascii=False), time.time(), task_id, worker_id)
+            )
+
+    def pending(self):
+        """
+        Number of tasks that are queued or leased.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status IN ('queued', 'leased')"
+            ).fetchone()[0]
+
+    def counts(self):
+        """
+        Number of tasks per status.
+        """
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+    def retry_failed(self):
+        """
+        Queue tasks that used up their attempts again with a fresh attempt count.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE tasks SET status='queued', attempts=0, updated_at=? WHERE status='failed'", (time.time(),)
+            ).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()